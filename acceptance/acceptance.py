@@ -71,6 +71,9 @@ from machine import Pin, Timer, UART
 MAX_CLOCK_FREQ_KHZ = 2.5
 OUTPUT_WIDTH = 5
 
+# Serial output baud rate of builds with a fractional divider, None when shifting one bit per clock cycle
+UART_BAUDRATE = None
+
 DELAY_CMD = 4
 
 PINS = {
@@ -397,7 +400,7 @@ pin_x2 = PINS["X2"]
 pin_led = Pin("LED", Pin.OUT)
 pin_led.high()
 
-uart = UART(1, baudrate=Clock.freq_hz, bits=8, parity=None, stop=1, rx=PINS["UART"], timeout=1)
+uart = UART(1, baudrate=UART_BAUDRATE or Clock.freq_hz, bits=8, parity=None, stop=1, rx=PINS["UART"], timeout=1)
 
 spoll = uselect.poll()
 spoll.register(sys.stdin, uselect.POLLIN)
@@ -0,0 +1,233 @@
+"""
+Monte Carlo characterization of the maximum encoder speed and of the miscount rate.
+
+The channels of a simulated Device (decoder, gearbox and counter, at config.CLOCK_FREQ) follow a random walk:
+transitions at a given rate (with some jitter), in the reverse direction with a small probability, the changing
+channel bouncing before settling. The counter, updated on X1 transitions with the gearbox disabled, is compared
+with the true position whenever the channels have settled (held long enough for the debounce and the counter update)
+and at the end of each run, each change of the difference counting as miscounted steps. Edge rate (up to about the
+clock frequency), bounce level and debounce mode are swept, each point being run several times with different random
+walks.
+
+Results are printed as a miscount rate vs speed table per debounce mode and bounce level (the miscount rate being the
+number of miscounted X1 steps per X1 step), with the highest rate without miscount; they can be saved as CSV for plots.
+Miscounts in opposite directions between two comparisons cancel out: at high rates the channels seldom settle, which
+is reported along with the miscounts.
+
+    python -m characterization.encoder_speed --workers 8 --csv encoder_speed.csv
+"""
+
+import argparse
+import csv
+import itertools
+import logging
+import random
+
+from amaranth import *
+from amaranth.sim import Simulator, Delay
+
+from characterization.sweep import sweep
+from hdl.device import Device
+
+import hdl.config as config
+
+# Gray code transitions per second, relative to the clock frequency: the decoder needs the channels held for 2 cycles,
+# which the random walks can no longer guarantee above half the clock frequency
+EDGE_RATES = tuple(
+    int(round(f * config.CLOCK_FREQ)) for f in (0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.48, 0.64, 0.8, 0.96))
+
+# Bounce level: number of extra pulses of the changing channel and time over which they spread (ms)
+BOUNCES = ((0, 0), (2, 0.5), (4, 1.5))
+
+# Debounce mode: off, direction based (None) or time based window (DBCWIN 1 to 3)
+DEBOUNCE_MODES = ("off", None, 1, 3)
+
+# Relative jitter of the time between transitions
+RATE_JITTER = 0.2
+
+REVERSE_PROBABILITY = 0.05
+
+TRANSITIONS = 64
+TRIALS = 8
+
+SEQUENCE = (0, 1, 3, 2)
+
+# Counter range, the comparison is made modulo
+MAX_VALUE = 255
+
+# Cycles from a change of the channels to the counter update, with some margin
+LATENCY_CYCLES = 4
+
+
+def run_point(point: (float, (int, float), object, int)) -> (int, int, int):
+
+    rate, bounce, debounce, trials = point
+
+    errors = 0
+    steps = 0
+    checks = 0
+    for seed in range(trials):
+        e, s, c = run_trial(rate, bounce, debounce, seed)
+        errors += e
+        steps += s
+        checks += c
+
+    return errors, steps, checks
+
+
+def signed_difference(a: int, b: int) -> int:
+
+    # Counter wraps around
+    d = (a - b) % (MAX_VALUE + 1)
+    return d if d <= MAX_VALUE // 2 else d - (MAX_VALUE + 1)
+
+
+def run_trial(rate: float, bounce: (int, float), debounce, seed: int) -> (int, int, int):
+
+    # String seed, as string hashes change from a process to the next
+    rng = random.Random(f"{rate}-{bounce}-{debounce}-{seed}")
+
+    # Configuration loaded at reset (boot preset 1)
+    preset = dict(
+        debounce=debounce != "off", debounce_window=debounce if isinstance(debounce, int) else 0,
+        wrap=True, gearbox=False, x1_value=SEQUENCE[0], max_value=MAX_VALUE, init_value=0)
+
+    dut = Device(boot_presets=[preset])
+
+    m = Module()
+    m.domains.sync = cd_sync = ClockDomain("sync")
+    m.submodules.dut = dut
+
+    period = 1 / config.CLOCK_FREQ
+
+    # Channels held for the time based debounce window and the counter update are settled
+    window = config.DECODER_DEBOUNCE_WINDOWS_MS[debounce - 1] * 1e-3 if isinstance(debounce, int) else 0
+    settle = window + LATENCY_CYCLES * period
+
+    # Random walk, with the true X1 position counted when entering x1_value, known once the channel settles
+    events = []
+    position = 0
+    true_x1 = 0
+    steps = 0
+
+    t = 0
+    for _ in range(TRANSITIONS):
+
+        direction = -1 if rng.random() < REVERSE_PROBABILITY else 1
+        prev = SEQUENCE[position % 4]
+        position += direction
+        channels = SEQUENCE[position % 4]
+
+        if channels == SEQUENCE[0]:
+            true_x1 += direction
+            steps += 1
+
+        # The changing channel toggles before settling at the end of the bounce time
+        count, duration = bounce
+        toggles = sorted(rng.uniform(0, duration * 1e-3) for _ in range(2 * count))
+        for i, dt in enumerate(toggles):
+            events.append((t + dt, channels if i % 2 == 0 else prev, None))
+        events.append((t + duration * 1e-3, channels, true_x1))
+
+        t += rng.uniform(1 - RATE_JITTER, 1 + RATE_JITTER) / rate
+
+    # Bounces may overlap the next transitions at high rates
+    events.sort(key=lambda e: e[0])
+
+    end = max(t, events[-1][0]) + 20 * period
+
+    # Counter and true X1 position at each settled position, then at the end
+    checks = []
+
+    def process():
+
+        # Reset with SDI high selects preset 1
+        yield dut.sdi.eq(1)
+        yield dut.cs.eq(1)
+        yield cd_sync.rst.eq(1)
+        yield Delay(4 * period)
+        yield cd_sync.rst.eq(0)
+        yield dut.sdi.eq(0)
+        yield Delay(4.5 * period)
+
+        now = 0
+        x1 = None
+        for t, channels, event_x1 in events:
+            if x1 is not None and t - now > settle:
+                yield Delay(settle)
+                checks.append(((yield dut.counter), x1))
+                now += settle
+            yield Delay(t - now)
+            now = t
+            yield dut.channels.eq(channels)
+            x1 = event_x1
+
+        yield Delay(end - now)
+        checks.append(((yield dut.counter), true_x1))
+
+    sim = Simulator(m)
+    sim.add_clock(period)
+    sim.add_process(process)
+    sim.run()
+
+    # Each change of the difference between the counter and the true position is a miscount
+    errors = 0
+    prev = 0
+    for counter, x1 in checks:
+        d = signed_difference(counter, x1)
+        errors += abs(signed_difference(d, prev))
+        prev = d
+
+    return errors, steps, len(checks)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    logger = logging.getLogger("encoder_speed")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=None, required=False,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("-t", "--trials", type=int, default=TRIALS, required=False,
+                        help="random walks per point")
+    parser.add_argument("--csv", type=str, default=None, required=False,
+                        help="save the results as CSV")
+
+    args = parser.parse_args()
+
+    points = list(itertools.product(EDGE_RATES, BOUNCES, DEBOUNCE_MODES))
+    results = dict(zip(points, sweep(run_point, [p + (args.trials,) for p in points], workers=args.workers)))
+
+    # Speeds for the default encoder
+    detents, transitions = config.GEARBOX_DEFAULT_ENCODER
+
+    logger.info(f"clock: {config.CLOCK_FREQ:.0f} Hz, {detents} detents / {transitions} transitions per detent encoder")
+    logger.info("rate (/s)  " + " ".join(f"{r:>7}" for r in EDGE_RATES))
+    logger.info("speed (/s) " + " ".join(f"{r / (detents * transitions):>7.2f}" for r in EDGE_RATES))
+
+    for debounce, bounce in itertools.product(DEBOUNCE_MODES, BOUNCES):
+
+        rates = [results[(r, bounce, debounce)] for r in EDGE_RATES]
+        label = "direction" if debounce is None else "off" if debounce == "off" else f"window {debounce}"
+        logger.info(f"debounce {label}, {bounce[0]} bounces over {bounce[1]} ms")
+        logger.info("miscounts  " + " ".join(f"{e / s:>7.3f}" for e, s, _ in rates))
+        # Miscounts in opposite directions between two comparisons cancel out, fewer comparisons hide more of them
+        logger.info("compared   " + " ".join(f"{c / s:>7.3f}" for _, s, c in rates) + " (settled positions per step)")
+
+        # Rates below the first one with miscounts
+        safe = list(itertools.takewhile(lambda x: x[1][0] == 0, zip(EDGE_RATES, rates)))
+        if safe:
+            logger.info(f"highest rate without miscount: {safe[-1][0]} transitions/s "
+                        f"({safe[-1][0] / (detents * transitions):.2f} turns/s)")
+        else:
+            logger.info("miscounts from the lowest rate")
+
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["debounce", "bounces", "bounce_ms", "rate", "miscounts", "steps", "miscount_rate",
+                             "comparisons"])
+            for (rate, bounce, debounce), (errors, steps, checks) in results.items():
+                writer.writerow(["direction" if debounce is None else debounce, bounce[0], bounce[1], rate,
+                                 errors, steps, errors / steps, checks])
@@ -0,0 +1,179 @@
+"""
+Sweep of the SPI timing accepted by the device, relative to its clock.
+
+Configuration words are sent to a simulated Device for each combination of SCK half period, CS setup (CS falling edge
+to the first SCK rising edge) and hold (last SCK rising edge to CS rising edge) times, and of the phase of the SPI
+signals relative to the clock. SDI changes along with the SCK falling edges, the first bit half a period before the
+first rising edge. All the times are in clock periods, negative setup and hold times putting the first or last
+rising edge outside of CS.
+
+The simulation has no metastability: each edge is instead delayed by a random fraction of the clock period
+(JITTER), independently for each signal, as a synchronizer may resolve a change on either clock edge around it.
+A point passes when every word was committed in all the trials. The pass / fail map is printed for each phase,
+along with the shortest half period passing at all phases, and can be saved as CSV.
+
+    python -m characterization.spi_timing --workers 8 --csv spi_timing.csv
+"""
+
+import argparse
+import csv
+import itertools
+import logging
+import random
+
+from amaranth.sim import Simulator, Delay
+
+from characterization.sweep import sweep
+from hdl.device import Device
+from hdl.spi_input import SPIInputChunked
+
+import hdl.config as config
+
+HALF_PERIODS = (1, 1.5, 2, 2.5, 3)
+SETUP_TIMES = (-1, 0, 1, 2, 3)
+HOLD_TIMES = (-1, 0, 1, 2, 3)
+PHASES = (0, 0.25, 0.5, 0.75)
+
+# Random delay of each edge, in clock periods
+JITTER = 1
+
+TRIALS = 4
+
+# Idle time between transactions, long enough for the configuration to be committed
+GAP = config.SPI_SYNC_STAGES + 4
+
+
+def run_point(point: (float, float, float, float, int)) -> bool:
+
+    half_period, setup, hold, phase, trials = point
+
+    return all(run_trial(half_period, setup, hold, phase, seed) for seed in range(trials))
+
+
+def run_trial(half_period: float, setup: float, hold: float, phase: float, seed: int) -> bool:
+
+    rng = random.Random(hash((half_period, setup, hold, phase, seed)))
+
+    dut = Device()
+
+    # Alternating bits and all fields changed from one word to the next
+    words = [
+        dict(debounce=False, wrap=True, gearbox=True, force_x2=False, x1_value=0b10,
+             gearbox_timer_cycles=0x55, max_value=0xAA, init_value=0x55),
+        dict(debounce=True, wrap=False, gearbox=False, force_x2=True, x1_value=0b01,
+             gearbox_timer_cycles=0xAA, max_value=0x55, init_value=0xAA)
+    ]
+
+    checks = {
+        "gearbox": dut._gearbox.enable,
+        "wrap": dut._internal_counter.wrap,
+        "debounce": dut._decoder.debounce,
+        "x1_value": dut._decoder.x1_value,
+        "gearbox_timer_cycles": dut._gearbox.timer_cycles,
+        "max_value": dut._internal_counter.max_value,
+        "init_value": dut._internal_counter.init_value
+    }
+
+    width = sum(w for _, w in dut.parameter_fields())
+    width += -width % config.SPI_WORD_LEN
+
+    period = 1 / config.CLOCK_FREQ
+
+    # Edges as (time, signal, value), jittered
+    events = [(0, dut.cs, 1)]
+
+    t = GAP + phase
+    for word in words:
+
+        v = dut.calculate_parameters_value(**word)
+
+        events.append((t, dut.cs, 0))
+
+        # Rising edge of each bit, SDI changing on the falling edge before it
+        rise = t + setup
+        for i in reversed(range(width)):
+            events += [(rise - half_period, dut.sdi, (v >> i) & 1), (rise - half_period, dut.sck, 0)]
+            events.append((rise, dut.sck, 1))
+            rise += 2 * half_period
+        rise -= 2 * half_period
+
+        events.append((rise + half_period, dut.sck, 0))
+        events.append((rise + hold, dut.cs, 1))
+
+        # Configuration is checked once committed
+        t = max(t, rise + half_period, rise + hold) + GAP
+        events.append((t, None, word))
+
+    events = sorted(((t + (rng.uniform(0, JITTER) if s is not None else 0), n, s, v)
+                     for n, (t, s, v) in enumerate(events)), key=lambda e: e[:2])
+
+    passed = []
+
+    def process():
+
+        now = 0
+        for t, _, signal, value in events:
+
+            yield Delay((t - now) * period)
+            now = t
+
+            if signal is not None:
+                yield signal.eq(value)
+            else:
+                ok = True
+                for name, s in checks.items():
+                    ok &= (yield s) == int(value[name])
+                passed.append(ok)
+
+    sim = Simulator(dut)
+    sim.add_clock(period)
+    sim.add_process(process)
+    sim.run()
+
+    return len(passed) == len(words) and all(passed)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
+    logger = logging.getLogger("spi_timing")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=None, required=False,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("-t", "--trials", type=int, default=TRIALS, required=False,
+                        help="simulations per point, with different edge delays")
+    parser.add_argument("--csv", type=str, default=None, required=False,
+                        help="save the results as CSV")
+
+    args = parser.parse_args()
+
+    points = list(itertools.product(HALF_PERIODS, SETUP_TIMES, HOLD_TIMES, PHASES))
+    results = dict(zip(points, sweep(run_point, [p + (args.trials,) for p in points], workers=args.workers)))
+
+    # Pass / fail map per phase, rows by half period, columns by setup / hold
+    columns = list(itertools.product(SETUP_TIMES, HOLD_TIMES))
+    for phase in PHASES:
+        logger.info(f"phase {phase} (columns: setup/hold)")
+        logger.info("half   " + " ".join(f"{s:>2}/{h:<2}" for s, h in columns))
+        for half_period in HALF_PERIODS:
+            logger.info(f"{half_period:<6} " + " ".join(
+                "  ok " if results[(half_period, s, h, phase)] else "   - " for s, h in columns))
+
+    for setup, hold in columns:
+        safe = [hp for hp in HALF_PERIODS if all(results[(hp, setup, hold, p)] for p in PHASES)]
+        if safe:
+            logger.info(f"setup {setup}, hold {hold}: shortest safe half period {min(safe)} clock cycles, "
+                        f"SCK up to {config.CLOCK_FREQ / (2 * min(safe)):.0f} Hz")
+        else:
+            logger.info(f"setup {setup}, hold {hold}: no safe half period")
+
+    logger.info(f"expected: half period {SPIInputChunked.MIN_HALF_PERIOD} clock cycles, "
+                f"SCK up to {SPIInputChunked.get_max_sck_freq(config.CLOCK_FREQ):.0f} Hz")
+
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["half_period", "setup", "hold", "phase", "passed"])
+            for point, passed in results.items():
+                writer.writerow(list(point) + [int(passed)])
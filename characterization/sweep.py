@@ -0,0 +1,25 @@
+import logging
+import multiprocessing
+
+
+def _init_worker():
+
+    # Devices log their build options, once per simulation
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def sweep(run, points: list, workers: int = None) -> list:
+
+    # Runs the simulations of the points in worker processes, results are in the order of the points
+
+    logger = logging.getLogger("sweep")
+    logger.info(f"{len(points)} points, {workers or multiprocessing.cpu_count()} workers")
+
+    results = []
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        for i, res in enumerate(pool.imap(run, points)):
+            results.append(res)
+            if (i + 1) % max(1, len(points) // 10) == 0:
+                logger.info(f"{i + 1}/{len(points)}")
+
+    return results
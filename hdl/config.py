@@ -1,27 +1,96 @@
 
 import hdl.util as util
 
+# Default clock frequency (Hz), Device derives its timings from the frequency it is built for
 CLOCK_FREQ = 2.5e3
 
+# Supported widths are 8, 16 and 32 bits
 COUNTER_WIDTH = 8
 OUTPUT_WIDTH = 5
 
+# Width of the (signed) wrap around count sent along with the counter on the UART, 0 to disable
+COUNTER_REVOLUTIONS_WIDTH = 0
+
 COUNTER_DEFAULT_MAX_VALUE = util.max_for_bits(OUTPUT_WIDTH)
 COUNTER_DEFAULT_VALUE = 0
 
 DECODER_DEFAULT_DEBOUNCE = True
+# Time based debounce windows selected by DBCWIN 1 to 3, 0 keeps the direction based debounce
+DECODER_DEFAULT_DEBOUNCE_WINDOW = 0
+DECODER_DEBOUNCE_WINDOWS_MS = (1, 2, 4)
 DECODER_DEFAULT_WRAP = False
 DECODER_DEFAULT_X1_VALUE = 0b00
 DECODER_DEFAULT_FORCE_X2 = False
+# Transitions decoded with logic ("logic") or looked up in a 16-entry ROM ("rom"), see GrayCodeDecoder
+DECODER_BACKEND = "logic"
 
 GEARBOX_DEFAULT_ENABLED = False
 GEARBOX_DEFAULT_ENCODER = (24, 4)
 
-UART_WORD_LEN = COUNTER_WIDTH
-assert UART_WORD_LEN >= COUNTER_WIDTH
+# Gears above X4 only increase the counter step size
+GEARBOX_GEARS = 3
+# Per gear change up/down thresholds (hysteresis) configurable over SPI, this extends the configuration word
+GEARBOX_THRESHOLDS = False
+
+# Drop to the lowest gear on direction reversal or after some timer periods without transition (0 to disable),
+# making it configurable over SPI extends the configuration word
+GEARBOX_DECAY = False
+GEARBOX_DEFAULT_RESET_ON_REVERSAL = False
+GEARBOX_DEFAULT_IDLE_PERIODS = 0
+
+# Counter step size per gear, given as exponent e for a step of 4^e (1, 4, 16 or 64), missing gears use a step of 1;
+# making it configurable over SPI extends the configuration word
+COUNTER_STEP_SIZES = False
+COUNTER_DEFAULT_STEP_EXPONENTS = (0, 0, 0)
+
+# Sigma-delta modulation instead of PWM, making it selectable over SPI extends the configuration word
+PWM_DEFAULT_SIGMA_DELTA = False
+PWM_MODES = False
 
-# Keep transmitter idle after stop bit
+# Wider values are sent as several frames, least significant word first
+UART_WORD_LEN = 8
+
+# Keep transmitter idle after stop bit (bit times)
 UART_IDLE_CYCLES = 4
 
-# This cannot be smaller than 8 to accommodate the gearbox parameter
+# Serial output baud rate derived from the clock with a fractional divider, None for one bit per clock cycle;
+# making it configurable over SPI extends the configuration word
+UART_BAUDRATE = None
+UART_BAUDRATE_SPI = False
+
+# Queue counter updates instead of only sending the latest value, 0 to disable
+UART_FIFO_DEPTH = 0
+
+# Send framed counter value and status (see TelemetryFrame) instead of the bare counter value
+UART_TELEMETRY = False
+
+# This cannot be smaller than 8 to accommodate the gearbox parameter and flags
 SPI_WORD_LEN = 8
+
+# Saturating counts of the changes suppressed by the debounce, counter saturations and invalid SPI transactions,
+# read along with the readback snapshot (requires SPI_READBACK) and cleared with each configuration
+EVENT_COUNTERS = False
+
+# Configuration presets loaded on the first cycle after reset, selected by holding SCK (MSB) and SDI while reset is
+# asserted (preset 1 to 3, 0 keeps the defaults), given as Device.calculate_parameters_value arguments overriding
+# the defaults, e.g. ({"wrap": True}, {"gearbox": True, "max_value": 255})
+BOOT_PRESETS = ()
+
+# Shift a snapshot of the counter, status and configuration out on SPI SDO, replaces counter bit 4 on the TT02 outputs
+SPI_READBACK = False
+
+# Snapshot of the parallel counter output frozen on request (force_x2 pin) and data ready pulse,
+# configured over SPI, this extends the configuration word
+PARALLEL_OUTPUT = False
+
+# Decoder strobes computed combinationally from the channels and serial frames started along with the counter update,
+# saving 1 cycle on the counter and 2 on the serial output (not available with telemetry)
+LOW_LATENCY = False
+
+# Clock domain (and its frequency in Hz) sampling the channels, None to decode in the sync domain,
+# steps are then accumulated and transferred to the sync domain (see FastDecoder)
+DECODER_DOMAIN = None
+DECODER_CLOCK_FREQ = None
+
+# Flip-flops resynchronizing the SPI inputs, SCK can then run up to a quarter of the clock (0 to sample the pins directly)
+SPI_SYNC_STAGES = 2
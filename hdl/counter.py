@@ -2,50 +2,143 @@ import logging
 import unittest
 
 from amaranth import *
+from amaranth.sim import Settle
 
 import hdl.util as util
 
 from hdl.test_common import TestCase, test_case
 
 
-class Counter(Elaboratable):
+class CounterUpdate(Elaboratable):
 
-    def __init__(self, width: int, default_value: int = 0, default_max_value: int = 0):
+    """
+    Next value of a counter, combinational, shared by Counter and DecoderBank.
+    """
 
-        assert util.max_for_bits(width) >= default_value
+    def __init__(self, width: int, default_max_value: int = 0):
 
         # Inputs
 
+        self.value = Signal(width)
         self.init_value = Signal(width)
         self.max_value = Signal(width, reset=default_max_value)
         self.wrap = Signal()
         self.inc = Signal()
+        # Units per update, the value saturates or wraps around when the full step does not fit,
+        # must not exceed max_value + 1
+        self.step = Signal(width, reset=1)
         self.strobe = Signal()
         self.reset = Signal()
 
         # Outputs
 
-        self.value = Signal(width, reset=default_value)
-        # Value will be updated on next cycle, does not strobe on reset
+        self.next_value = Signal(width)
+        # Value will be updated, not on reset
         self.updating_strobe = Signal()
+        # The step did not fit and the value was held at the limit
+        self.saturated = Signal()
+        # The value wrapped around, past max_value when incrementing
+        self.wrapped = Signal()
 
     def elaborate(self, platform) -> Module:
 
         m = Module()
 
-        can_update = Signal()
-        m.d.comb += can_update.eq(Mux(self.inc, self.value != self.max_value, self.value.any()))
+        # Value clamped to max_value, which can be lowered below it while counting
+        value = Signal.like(self.value)
+        m.d.comb += value.eq(Mux(self.value > self.max_value, self.max_value, self.value))
+
+        # Units left before reaching the limit in the current direction
+        room = Signal.like(self.value)
+        m.d.comb += room.eq(Mux(self.inc, self.max_value - value, value))
 
-        m.d.comb += self.updating_strobe.eq(self.strobe & (self.wrap | can_update))
+        can_update = Signal()
+        can_step = Signal()
+        m.d.comb += [
+            can_update.eq(room != 0),
+            can_step.eq(self.step <= room)
+        ]
+
+        m.d.comb += [
+            self.updating_strobe.eq(self.strobe & (self.wrap | can_update)),
+            self.saturated.eq(self.strobe & ~self.wrap & ~can_step & ~self.reset),
+            self.wrapped.eq(self.updating_strobe & self.wrap & ~can_step & ~self.reset)
+        ]
 
         with m.If(self.reset):
-            m.d.sync += self.value.eq(self.init_value)
+            m.d.comb += self.next_value.eq(self.init_value)
 
         with m.Elif(self.updating_strobe):
-            with m.If(can_update):
-                m.d.sync += self.value.eq(self.value + Mux(self.inc, 1, -1))
+            with m.If(can_step):
+                m.d.comb += self.next_value.eq(Mux(self.inc, value + self.step, value - self.step))
+            with m.Elif(self.wrap):
+                # Remainder of the step is applied from the other limit
+                m.d.comb += self.next_value.eq(
+                    Mux(self.inc, self.step - room - 1, self.max_value - (self.step - room - 1)))
+            with m.Else():
+                m.d.comb += self.next_value.eq(Mux(self.inc, self.max_value, 0))
+
+        with m.Else():
+            m.d.comb += self.next_value.eq(value)
+
+        return m
+
+
+class Counter(Elaboratable):
+
+    def __init__(self, width: int, default_value: int = 0, default_max_value: int = 0, revolutions_width: int = 0):
+
+        assert util.max_for_bits(width) >= default_value
+
+        self.revolutions_width = revolutions_width
+
+        self._update = CounterUpdate(width, default_max_value=default_max_value)
+
+        # Inputs (see CounterUpdate)
+
+        self.init_value = self._update.init_value
+        self.max_value = self._update.max_value
+        self.wrap = self._update.wrap
+        self.inc = self._update.inc
+        self.step = self._update.step
+        self.strobe = self._update.strobe
+        self.reset = self._update.reset
+
+        # Outputs
+
+        self.value = Signal(width, reset=default_value)
+        # Value on next cycle
+        self.next_value = self._update.next_value
+        # Value will be updated on next cycle, does not strobe on reset
+        self.updating_strobe = self._update.updating_strobe
+        # The step did not fit and the value was held at the limit
+        self.saturated = self._update.saturated
+        # Number of times the value wrapped around (signed, incremented past max_value),
+        # together with value this gives the absolute position: revolutions * (max_value + 1) + value
+        self.revolutions = Signal(signed(revolutions_width))
+        self.next_revolutions = Signal(signed(revolutions_width))
+
+    def elaborate(self, platform) -> Module:
+
+        m = Module()
+
+        m.submodules.update = update = self._update
+        m.d.comb += update.value.eq(self.value)
+
+        m.d.sync += self.value.eq(self.next_value)
+
+        if self.revolutions_width:
+
+            m.d.sync += self.revolutions.eq(self.next_revolutions)
+
+            with m.If(self.reset):
+                m.d.comb += self.next_revolutions.eq(0)
+
+            with m.Elif(update.wrapped):
+                m.d.comb += self.next_revolutions.eq(self.revolutions + Mux(self.inc, 1, -1))
+
             with m.Else():
-                m.d.sync += self.value.eq(Mux(self.inc, 0, self.max_value))
+                m.d.comb += self.next_revolutions.eq(self.revolutions)
 
         return m
 
@@ -132,9 +225,120 @@ class CounterTestSuite(TestCase):
 
         self.assertEqual(v, 0)
 
+    @test_case
+    def test_parameters_lower_max(self):
+        yield from self.do_run(
+            max_value=self.COUNTER_MAX_VALUE, inc=True, wrap=False, repeat=20,
+            expected=20)
+
+        # Clamped without any update, then saturates
+        yield self.dut.max_value.eq(10)
+        yield
+        yield
+
+        v = yield self.dut.value
+        self.assertEqual(v, 10)
+
+        yield from self.do_run(
+            max_value=10, inc=True, wrap=False, repeat=1,
+            expected=10)
+
     # TODO: test init value
 
 
+class CounterStepTestSuite(TestCase):
+
+    COUNTER_WIDTH = 8
+
+    def instantiate_dut(self):
+        return Counter(width=self.COUNTER_WIDTH)
+
+    def do_run(self, max_value: int, step: int, wrap: bool, inc: bool, start: int, expected: [int]):
+
+        yield self.dut.init_value.eq(start)
+        yield self.dut.reset.eq(1)
+        yield
+        yield self.dut.reset.eq(0)
+
+        yield self.dut.max_value.eq(max_value)
+        yield self.dut.step.eq(step)
+        yield self.dut.inc.eq(int(inc))
+        yield self.dut.wrap.eq(int(wrap))
+
+        values = []
+        saturated = []
+        for _ in expected:
+            yield self.dut.strobe.eq(1)
+            yield Settle()
+            v = yield self.dut.saturated
+            saturated.append(v)
+            yield
+            yield self.dut.strobe.eq(0)
+            yield
+            v = yield self.dut.value
+            values.append(v)
+
+        self.assertEqual(values, expected)
+
+        return saturated
+
+    @test_case
+    def test_saturate_inc(self):
+        saturated = yield from self.do_run(max_value=9, step=4, wrap=False, inc=True, start=0, expected=[4, 8, 9, 9])
+        self.assertEqual(saturated, [0, 0, 1, 1])
+
+    @test_case
+    def test_saturate_dec(self):
+        saturated = yield from self.do_run(max_value=9, step=4, wrap=False, inc=False, start=9, expected=[5, 1, 0, 0])
+        self.assertEqual(saturated, [0, 0, 1, 1])
+
+    @test_case
+    def test_wrap_inc(self):
+        yield from self.do_run(max_value=9, step=4, wrap=True, inc=True, start=0, expected=[4, 8, 2, 6, 0])
+
+    @test_case
+    def test_wrap_dec(self):
+        yield from self.do_run(max_value=9, step=4, wrap=True, inc=False, start=2, expected=[8, 4, 0, 6])
+
+    @test_case
+    def test_wrap_full_range(self):
+        yield from self.do_run(max_value=255, step=64, wrap=True, inc=True, start=200, expected=[8, 72, 136, 200])
+
+
+class CounterRevolutionsTestSuite(CounterTestSuite):
+
+    REVOLUTIONS_WIDTH = 8
+
+    def instantiate_dut(self):
+        return Counter(width=self.COUNTER_WIDTH, revolutions_width=self.REVOLUTIONS_WIDTH)
+
+    def do_check_position(self, max_value: int, inc: bool, repeat: int, expected: int):
+
+        yield from self.do_run(
+            max_value=max_value, inc=inc, wrap=True, repeat=repeat,
+            expected=expected % (max_value + 1))
+
+        r = yield self.dut.revolutions
+        self.assertEqual(r, expected // (max_value + 1))
+
+    @test_case
+    def test_revolutions_inc(self):
+        yield from self.do_check_position(max_value=9, inc=True, repeat=25, expected=25)
+
+    @test_case
+    def test_revolutions_dec(self):
+        yield from self.do_check_position(max_value=9, inc=False, repeat=25, expected=-25)
+
+    @test_case
+    def test_revolutions_nowrap(self):
+        yield from self.do_run(
+            max_value=9, inc=True, wrap=False, repeat=25,
+            expected=9)
+
+        r = yield self.dut.revolutions
+        self.assertEqual(r, 0)
+
+
 if __name__ == "__main__":
     logging.root.setLevel(logging.DEBUG)
     unittest.main()
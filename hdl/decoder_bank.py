@@ -0,0 +1,265 @@
+import logging
+import unittest
+
+from amaranth import *
+
+import hdl.util as util
+
+from hdl.counter import CounterUpdate
+from hdl.gray_code_decoder import TransitionDecoder
+from hdl.uart_output import UARTOutput
+from hdl.test_common import TestCase, test_case
+
+
+class DecoderBank(Elaboratable):
+
+    """
+    Gray code decoders and counters for several encoders, sharing a single decoder and counter update logic.
+
+    The encoders are served in turn, one per cycle: the state of each (previous channels, counter value)
+    is kept in a register file, read, updated and written back when its turn comes. An encoder is therefore sampled
+    every `encoders` cycles, which is the minimum time between two transitions of its channels.
+
+    Counter updates are sent on the serial output as tagged frames: encoder index byte, then counter value
+    least significant byte first; they are queued in a FIFO as several encoders can be updated in a row.
+
+    The configuration is shared by all the encoders (no debounce, X1 / X2 / X4 updates as with GrayCodeDecoder),
+    the transitions and counter updates being computed with the same logic (TransitionDecoder and CounterUpdate).
+    The first scan after reset only records the channels.
+
+    Inputs:
+        * channels: 2 bits per encoder, encoder 0 in the least significant bits
+        * max_value, wrap, x1_value, force_x2, x4: configuration
+        * read_index: encoder whose counter value is output on read_value
+
+    Outputs:
+        * read_value: counter value of encoder read_index
+        * tx: serial output
+
+    """
+
+    TAG_WIDTH = 8
+
+    DEFAULT_FIFO_DEPTH = 4
+
+    def __init__(
+            self,
+            encoders: int,
+            width: int,
+            default_max_value: int = None,
+            fifo_depth: int = DEFAULT_FIFO_DEPTH,
+            word_len: int = UARTOutput.DEFAULT_WORD_LEN,
+            idle_cycles: int = UARTOutput.DEFAULT_IDLE_CYCLES):
+
+        assert 1 < encoders <= 1 << self.TAG_WIDTH, "unsupported number of encoders"
+
+        self.encoders = encoders
+        self.width = width
+
+        # Inputs
+        self.channels = Signal(2 * encoders)
+        self.max_value = Signal(width, reset=util.max_for_bits(width) if default_max_value is None else default_max_value)
+        self.wrap = Signal()
+        self.x1_value = Signal(2)
+        self.force_x2 = Signal()
+        self.x4 = Signal()
+        self.read_index = Signal(range(encoders))
+
+        # Outputs
+        self.read_value = Signal(width)
+
+        self._serial_out = UARTOutput(
+            width=util.bits_multiple(self.TAG_WIDTH, word_len) + width, word_len=word_len, idle_cycles=idle_cycles,
+            fifo_depth=fifo_depth, immediate=True)
+
+        self.tx = self._serial_out.tx
+        self.overflow = self._serial_out.overflow
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info("{} encoders, {} bits".format(encoders, width))
+
+    def elaborate(self, platform) -> Module:
+
+        m = Module()
+
+        m.submodules.serial_out = self._serial_out
+
+        # Per encoder state: counter value, previous channels
+        state_width = self.width + 2
+        mem = Memory(width=state_width, depth=self.encoders)
+
+        m.submodules.rd = rd = mem.read_port(domain="comb")
+        m.submodules.wr = wr = mem.write_port()
+        m.submodules.read = read = mem.read_port(domain="comb")
+
+        m.d.comb += [
+            read.addr.eq(self.read_index),
+            self.read_value.eq(read.data[0:self.width])
+        ]
+
+        # Encoder served this cycle, the first scan primes the previous channels
+        index = Signal(range(self.encoders))
+        priming = Signal(reset=1)
+
+        with m.If(index == self.encoders - 1):
+            m.d.sync += [
+                index.eq(0),
+                priming.eq(0)
+            ]
+        with m.Else():
+            m.d.sync += index.eq(index + 1)
+
+        # Channels are sampled all at once
+        channels = Signal.like(self.channels)
+        m.d.sync += channels.eq(self.channels)
+
+        value = Signal(self.width)
+        prev_channels = Signal(2)
+        m.d.comb += [
+            rd.addr.eq(index),
+            Cat(value, prev_channels).eq(rd.data)
+        ]
+
+        ch = Signal(2)
+        m.d.comb += ch.eq(channels.word_select(index, 2))
+
+        # Decoder, as GrayCodeDecoder without debounce
+
+        m.submodules.transition = transition = TransitionDecoder()
+        m.d.comb += [
+            transition.channels.eq(ch),
+            transition.prev_channels.eq(prev_channels)
+        ]
+
+        strobe_x4 = Signal()
+        m.d.comb += strobe_x4.eq(~priming & transition.changed)
+
+        _, strobe_x1 = TransitionDecoder.get_update_strobes(strobe_x4, ch, self.x1_value, self.force_x2)
+
+        # Counter, as Counter with unit steps
+
+        m.submodules.update = update = CounterUpdate(self.width)
+        m.d.comb += [
+            update.value.eq(value),
+            update.max_value.eq(self.max_value),
+            update.wrap.eq(self.wrap),
+            update.inc.eq(transition.direction),
+            update.strobe.eq(Mux(self.x4, strobe_x4, strobe_x1))
+        ]
+
+        m.d.comb += [
+            wr.addr.eq(index),
+            wr.data.eq(Cat(update.next_value, ch)),
+            wr.en.eq(1)
+        ]
+
+        # Tagged frame, index byte first
+
+        m.d.comb += [
+            self._serial_out.word.eq(Cat(index, Const(0, self.TAG_WIDTH - len(index)), update.next_value)),
+            self._serial_out.strobe.eq(update.updating_strobe)
+        ]
+
+        return m
+
+
+#######################################################################################################################
+
+
+class DecoderBankTestSuite(TestCase):
+
+    ENCODERS = 4
+    WIDTH = 8
+
+    SEQUENCE_INC = [1, 3, 2, 0]
+    SEQUENCE_DEC = [2, 3, 1, 0]
+
+    # Cycles each channels value is held, at least one scan, long enough to send the updates of all encoders
+    HOLD_CYCLES = 80
+
+    def instantiate_dut(self):
+        return DecoderBank(encoders=self.ENCODERS, width=self.WIDTH)
+
+    def decode(self, tx: [int]) -> [(int, int)]:
+
+        bytes_ = []
+
+        bits = None
+        for v in tx:
+            if bits is None:
+                if not v:
+                    bits = []
+            elif len(bits) < 8:
+                bits.append(v)
+            else:
+                self.assertEqual(v, 1, "missing stop bit")
+                bytes_.append(sum(b << i for i, b in enumerate(bits)))
+                bits = None
+
+        n = 1 + (self.WIDTH + 7) // 8
+        return [(f[0], sum(b << (i * 8) for i, b in enumerate(f[1:])))
+                for f in (bytes_[i:i + n] for i in range(0, len(bytes_), n))]
+
+    @test_case
+    def test(self):
+
+        dut = self.dut
+
+        yield dut.x4.eq(1)
+        yield dut.wrap.eq(1)
+
+        # Encoder 0 incrementing, 1 decrementing, 2 incrementing once, 3 still
+        sequences = [self.SEQUENCE_INC * 2, self.SEQUENCE_DEC * 2, self.SEQUENCE_INC[:1], []]
+        expected = [8, -8, 1, 0]
+
+        channels = [0] * self.ENCODERS
+        yield dut.channels.eq(0)
+        for _ in range(self.HOLD_CYCLES):
+            yield
+
+        tx = []
+        for step in range(max(len(s) for s in sequences)):
+
+            for e, s in enumerate(sequences):
+                if step < len(s):
+                    channels[e] = s[step]
+            yield dut.channels.eq(sum(c << (2 * e) for e, c in enumerate(channels)))
+
+            for _ in range(self.HOLD_CYCLES):
+                tx.append((yield dut.tx))
+                yield
+
+        for _ in range(40 * 30):
+            tx.append((yield dut.tx))
+            yield
+
+        for e, x in enumerate(expected):
+            yield dut.read_index.eq(e)
+            yield
+            v = yield dut.read_value
+            self.assertEqual(v, x % (1 << self.WIDTH), "encoder {}".format(e))
+
+        v = yield dut.overflow
+        self.assertFalse(v)
+
+        # Last frame of each updated encoder holds its value
+        frames = self.decode(tx)
+        self.assertEqual(len(frames), sum(abs(x) for x in expected))
+
+        last = {}
+        for e, v in frames:
+            last[e] = v
+        self.assertEqual(last, {e: x % (1 << self.WIDTH) for e, x in enumerate(expected) if x})
+
+
+class DecoderBankTestSuite2(DecoderBankTestSuite):
+
+    ENCODERS = 5
+    WIDTH = 16
+
+    HOLD_CYCLES = 160
+
+
+if __name__ == "__main__":
+    logging.root.setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,24 @@
+import os
+
+from amaranth.back import verilog
+
+from hdl.gray_code_decoder import GrayCodeDecoder
+
+
+if __name__ == "__main__":
+
+    # Decoder alone, to compare the area and logic depth of the backends (see make decoder_stats)
+
+    top_name = os.environ.get("TOP", "decoder")
+    backend = os.environ.get("BACKEND", GrayCodeDecoder.BACKEND_LOGIC)
+
+    module = GrayCodeDecoder(backend=backend)
+
+    v = verilog.convert(
+        module, name=top_name,
+        ports=[
+            module.channels, module.debounce, module.debounce_window, module.x1_value, module.force_x2,
+            module.direction, module.strobe_x4, module.strobe_x2, module.strobe_x1, module.suppressed, module.error
+        ],
+        emit_src=False, strip_internal_attrs=True)
+    print(v)
@@ -1,33 +1,130 @@
 import logging
+import math
 import unittest
 
 from amaranth import *
+from amaranth.sim import Settle
 
 from hdl.gray_code_decoder import GrayCodeDecoder
+from hdl.fast_decoder import FastDecoder
 from hdl.counter import Counter
 from hdl.pwm_signal import PWMSignal
 from hdl.gearbox import Gearbox
 from hdl.uart_output import UARTOutput
 from hdl.spi_input import SPIInputChunked
+from hdl.telemetry_frame import TelemetryFrame
+from hdl.parallel_output import ParallelOutput
 
 import hdl.config as config
 import hdl.util as util
 
-from hdl.test_common import TestCase, test_case
+from hdl.test_common import TestCase, add_fast_channels, test_case
 
 
 class Device(Elaboratable):
 
-    def __init__(self):
-
-        width = config.COUNTER_WIDTH
-        assert width <= 8
-
-        self._decoder = GrayCodeDecoder()
-        self._pwm_signal = PWMSignal(width=width)
-        self._gearbox = Gearbox(self._decoder)
-        self._serial_out = UARTOutput(width=width, word_len=config.UART_WORD_LEN, idle_cycles=config.UART_IDLE_CYCLES)
-        self._internal_counter = Counter(width=width)
+    SUPPORTED_WIDTHS = (8, 16, 32)
+
+    # Step size is 4^e for each gear, 2 bits per exponent
+    STEP_EXPONENT_WIDTH = 2
+
+    # Commands sent as SPI addressed writes beyond the configuration word
+    COMMAND_COUNTER_RESET = 0xFF
+
+    # Saturating event counts in the readback snapshot (event_counters)
+    EVENT_COUNT_WIDTH = 8
+
+    # Output pin replaced by the data ready pulse (output_data_ready)
+    DATA_READY_NONE = 0
+    DATA_READY_SERIAL = 1
+    DATA_READY_PWM = 2
+    DATA_READY_DIRECTION = 3
+
+    # Signals on the PWM and direction outputs (output_status)
+    OUTPUT_STATUS_NONE = 0
+    OUTPUT_STATUS_GEAR = 1
+    OUTPUT_STATUS_GEAR_DIRECTION = 2
+    OUTPUT_STATUS_OVERFLOW_DIRECTION = 3
+
+    def __init__(
+            self,
+            clock_freq: float = config.CLOCK_FREQ,
+            width: int = config.COUNTER_WIDTH,
+            revolutions_width: int = config.COUNTER_REVOLUTIONS_WIDTH,
+            step_sizes: bool = config.COUNTER_STEP_SIZES,
+            gears: int = config.GEARBOX_GEARS,
+            gearbox_thresholds: bool = config.GEARBOX_THRESHOLDS,
+            gearbox_decay: bool = config.GEARBOX_DECAY,
+            pwm_modes: bool = config.PWM_MODES,
+            uart_fifo_depth: int = config.UART_FIFO_DEPTH,
+            uart_telemetry: bool = config.UART_TELEMETRY,
+            uart_baudrate: float = config.UART_BAUDRATE,
+            uart_baudrate_spi: bool = config.UART_BAUDRATE_SPI,
+            spi_readback: bool = config.SPI_READBACK,
+            low_latency: bool = config.LOW_LATENCY,
+            parallel_output: bool = config.PARALLEL_OUTPUT,
+            decoder_domain: str = config.DECODER_DOMAIN,
+            decoder_clock_freq: float = config.DECODER_CLOCK_FREQ,
+            boot_presets: [dict] = config.BOOT_PRESETS,
+            event_counters: bool = config.EVENT_COUNTERS,
+            decoder_backend: str = config.DECODER_BACKEND):
+
+        assert uart_baudrate is not None or not uart_baudrate_spi, "baud rate configuration requires a baud rate"
+
+        assert not (low_latency and uart_telemetry), "low latency is not available with telemetry"
+        assert not (low_latency and decoder_domain), "low latency requires decoding in the sync domain"
+        assert decoder_domain is None or decoder_clock_freq, "decoder domain requires its clock frequency"
+        assert spi_readback or not event_counters, "event counters are read with the readback snapshot"
+
+        assert width in self.SUPPORTED_WIDTHS, "unsupported counter width {}".format(width)
+
+        self.clock_freq = clock_freq
+        self.width = width
+        self.step_sizes = step_sizes
+        self.gears = gears
+        self.gearbox_thresholds = gearbox_thresholds
+        self.gearbox_decay = gearbox_decay
+        self.pwm_modes = pwm_modes
+        self.uart_baudrate_spi = uart_baudrate_spi
+        self.spi_readback = spi_readback
+        self.low_latency = low_latency
+        self.parallel_output = parallel_output
+        self.decoder_domain = decoder_domain
+        self.boot_presets = boot_presets
+        self.event_counters = event_counters
+
+        self.uart_baud_increment = None
+        if uart_baudrate is not None:
+            self.uart_baud_increment = UARTOutput.get_baud_increment(uart_baudrate, clock_freq)
+
+        self.gearbox_period, self.gearbox_timer_cycles = Gearbox.get_timer_period(
+            *config.GEARBOX_DEFAULT_ENCODER, clock=clock_freq)
+
+        if decoder_domain is not None:
+            # All the steps made between two cycles are transferred, and applied at once to the counter
+            position_width = FastDecoder.get_position_width(decoder_clock_freq / clock_freq)
+            assert position_width - 1 <= width, "too many fast decoder steps per cycle for the counter width"
+            self._decoder = FastDecoder(domain=decoder_domain, debounce_windows=[
+                int(math.ceil(ms * 1e-3 * decoder_clock_freq)) for ms in config.DECODER_DEBOUNCE_WINDOWS_MS],
+                position_width=position_width, backend=decoder_backend)
+        else:
+            self._decoder = GrayCodeDecoder(debounce_windows=[
+                int(math.ceil(ms * 1e-3 * clock_freq)) for ms in config.DECODER_DEBOUNCE_WINDOWS_MS],
+                comb_strobe=low_latency, backend=decoder_backend)
+        self._pwm_signal = PWMSignal(width=width, default_sigma_delta=config.PWM_DEFAULT_SIGMA_DELTA)
+        self._gearbox = Gearbox(
+            self._decoder, gears=gears,
+            default_timer_cycles=self.gearbox_timer_cycles,
+            timer_cycles_width=Gearbox.get_timer_cycles_width(self.gearbox_timer_cycles),
+            default_reset_on_reversal=config.GEARBOX_DEFAULT_RESET_ON_REVERSAL,
+            default_idle_periods=config.GEARBOX_DEFAULT_IDLE_PERIODS)
+        self._telemetry = TelemetryFrame(width=width + revolutions_width) if uart_telemetry else None
+        self._serial_out = UARTOutput(
+            width=len(self._telemetry.frame) if uart_telemetry else width + revolutions_width,
+            word_len=config.UART_WORD_LEN, idle_cycles=config.UART_IDLE_CYCLES,
+            fifo_depth=uart_fifo_depth, default_baud_increment=self.uart_baud_increment, immediate=low_latency)
+        self._internal_counter = Counter(width=width, revolutions_width=revolutions_width)
+        self._parallel_out = ParallelOutput(width=width, output_width=config.OUTPUT_WIDTH) if parallel_output else None
 
         # Inputs
         self.force_x2 = Signal()
@@ -38,30 +135,218 @@ class Device(Elaboratable):
 
         # Outputs
         self.counter = Signal(width)
+        self.revolutions = Signal(signed(revolutions_width))
         self.direction = self._decoder.direction
         self.pwm = self._pwm_signal.signal
         self.serial_tx = self._serial_out.tx
+        # Counter updates were not sent since configuration
+        self.serial_overflow = self._serial_out.overflow
+        # SPI readback, see readback_fields()
+        self.sdo = Signal()
+        # Output pins: serial_tx, pwm, direction, then counter LSBs (or as configured)
+        self.outputs = Signal(3 + config.OUTPUT_WIDTH)
 
         self.logger = logging.getLogger(self.__class__.__name__)
 
-    @staticmethod
+    def parameter_fields(self) -> [(str, int)]:
+
+        # Layout of the SPI parameter word from LSB, fields without name are unused
+        # Counter values take as many SPI words as required by the counter width
+
+        assert config.SPI_WORD_LEN >= 8
+
+        value_width = util.bits_multiple(self.width, multiple_of=config.SPI_WORD_LEN)
+
+        fields = [
+            ("gearbox", 1),
+            ("wrap", 1),
+            ("debounce", 1),
+            ("x1_value", 2),
+            ("force_x2", 1),
+            ("debounce_window", 2),
+            (None, config.SPI_WORD_LEN - 8),
+            ("gearbox_timer_cycles", util.bits_multiple(
+                Gearbox.get_timer_cycles_width(self.gearbox_timer_cycles), multiple_of=config.SPI_WORD_LEN)),
+            ("init_value", value_width),
+            ("max_value", value_width),
+        ]
+
+        # Extensions
+
+        if self.step_sizes:
+            fields += [("step_exponents", util.bits_multiple(
+                self.gears * self.STEP_EXPONENT_WIDTH, multiple_of=config.SPI_WORD_LEN))]
+
+        # One SPI word per threshold
+        if self.gearbox_thresholds:
+            fields += [
+                ("gearbox_up_thresholds", (self.gears - 1) * config.SPI_WORD_LEN),
+                ("gearbox_down_thresholds", (self.gears - 1) * config.SPI_WORD_LEN)
+            ]
+
+        if self.gearbox_decay:
+            fields += [
+                ("gearbox_reset_on_reversal", 1),
+                ("gearbox_idle_periods", Gearbox.IDLE_PERIODS_WIDTH),
+                (None, util.bits_multiple(1 + Gearbox.IDLE_PERIODS_WIDTH, config.SPI_WORD_LEN) - 1 - Gearbox.IDLE_PERIODS_WIDTH)
+            ]
+
+        if self.pwm_modes:
+            fields += [
+                ("pwm_sigma_delta", 1),
+                (None, config.SPI_WORD_LEN - 1)
+            ]
+
+        if self.uart_baudrate_spi:
+            fields += [("uart_baud_increment", util.bits_multiple(UARTOutput.BAUD_ACC_WIDTH, config.SPI_WORD_LEN))]
+
+        if self.parallel_output:
+            fields += [
+                ("output_snapshot", 1),
+                ("output_data_ready", 2),
+                (None, config.SPI_WORD_LEN - 3),
+                ("output_mode", 2),
+                ("output_status", 2),
+                (None, config.SPI_WORD_LEN - 4)
+            ]
+
+        return fields
+
     def calculate_parameters_value(
+            self,
             wrap: bool, debounce: bool, gearbox: bool, force_x2: bool,
             x1_value: int,
             gearbox_timer_cycles: int,
             init_value: int,
-            max_value: int):
+            max_value: int,
+            debounce_window: int = config.DECODER_DEFAULT_DEBOUNCE_WINDOW,
+            step_exponents: [int] = None,
+            gearbox_up_thresholds: [int] = None,
+            gearbox_down_thresholds: [int] = None,
+            gearbox_reset_on_reversal: bool = config.GEARBOX_DEFAULT_RESET_ON_REVERSAL,
+            gearbox_idle_periods: int = config.GEARBOX_DEFAULT_IDLE_PERIODS,
+            pwm_sigma_delta: bool = config.PWM_DEFAULT_SIGMA_DELTA,
+            uart_baud_increment: int = None,
+            output_snapshot: bool = False,
+            output_data_ready: int = DATA_READY_NONE,
+            output_mode: int = ParallelOutput.MODE_DIRECT,
+            output_status: int = OUTPUT_STATUS_NONE) -> int:
+
+        if step_exponents is None:
+            step_exponents = (tuple(config.COUNTER_DEFAULT_STEP_EXPONENTS) + (0,) * self.gears)[:self.gears]
+        if uart_baud_increment is None:
+            uart_baud_increment = self.uart_baud_increment
+        if gearbox_up_thresholds is None:
+            gearbox_up_thresholds = Gearbox.get_default_thresholds(self.gears)
+        if gearbox_down_thresholds is None:
+            gearbox_down_thresholds = gearbox_up_thresholds
+
+        assert len(step_exponents) == self.gears, "expected one step exponent per gear"
+        assert len(gearbox_up_thresholds) == len(gearbox_down_thresholds) == self.gears - 1, \
+            "expected one threshold per gear change"
+        for t in list(gearbox_up_thresholds) + list(gearbox_down_thresholds):
+            assert 0 <= t <= util.max_for_bits(Gearbox.THRESHOLD_WIDTH), "gearbox threshold out of range: {}".format(t)
+
+        values = {
+            "gearbox": gearbox,
+            "wrap": wrap,
+            "debounce": debounce,
+            "x1_value": x1_value,
+            "force_x2": force_x2,
+            "debounce_window": debounce_window,
+            "gearbox_timer_cycles": gearbox_timer_cycles,
+            "init_value": init_value,
+            "max_value": max_value,
+            "step_exponents": sum(e << (i * self.STEP_EXPONENT_WIDTH) for i, e in enumerate(step_exponents)),
+            "gearbox_up_thresholds": sum(t << (i * config.SPI_WORD_LEN) for i, t in enumerate(gearbox_up_thresholds)),
+            "gearbox_down_thresholds": sum(t << (i * config.SPI_WORD_LEN) for i, t in enumerate(gearbox_down_thresholds)),
+            "gearbox_reset_on_reversal": gearbox_reset_on_reversal,
+            "gearbox_idle_periods": gearbox_idle_periods,
+            "pwm_sigma_delta": pwm_sigma_delta,
+            "uart_baud_increment": uart_baud_increment,
+            "output_snapshot": output_snapshot,
+            "output_data_ready": output_data_ready,
+            "output_mode": output_mode,
+            "output_status": output_status
+        }
+
+        res = 0
+        offset = 0
+        for name, width in self.parameter_fields():
+            if name is not None:
+                v = int(values[name])
+                assert 0 <= v <= util.max_for_bits(width), "{} out of range: {}".format(name, v)
+                res |= v << offset
+            offset += width
+
+        # With readback, a transaction with SDI high at every SCK rising edge is a read, not a write
+        assert not self.spi_readback or \
+            res != util.max_for_bits(util.bits_multiple(offset, multiple_of=config.SPI_WORD_LEN)), \
+            "the all-ones configuration word is taken as a read"
+
+        return res
+
+    def readback_fields(self) -> [(str, int)]:
+
+        # Layout of the SPI readback snapshot from LSB, shifted out from the MSB: counter first, configuration word last
+
+        fields = [
+            ("parameters", util.bits_multiple(
+                sum(w for _, w in self.parameter_fields()), multiple_of=config.SPI_WORD_LEN))
+        ]
+
+        if self.event_counters:
+            fields += [
+                ("spi_error_count", self.EVENT_COUNT_WIDTH),
+                ("saturated_count", self.EVENT_COUNT_WIDTH),
+                ("suppressed_count", self.EVENT_COUNT_WIDTH)
+            ]
+
+        return fields + [
+            ("dropped_count", UARTOutput.DROPPED_COUNT_WIDTH),
+            ("direction", 1),
+            ("gear", TelemetryFrame.GEAR_WIDTH),
+            ("serial_overflow", 1),
+            (None, 3),
+            ("revolutions", util.bits_multiple(self.revolutions.width, multiple_of=8)),
+            ("counter", self.width)
+        ]
+
+    def parse_readback_value(self, value: int) -> dict:
 
-        assert config.SPI_WORD_LEN >= 6
+        res = {}
+        offset = 0
+        for name, width in self.readback_fields():
+            if name is not None:
+                res[name] = (value >> offset) & util.max_for_bits(width)
+            offset += width
 
-        return int(gearbox) |\
-               (int(wrap) << 1) |\
-               (int(debounce) << 2) |\
-               (x1_value << 3) | \
-               (int(force_x2) << 5) |\
-               (gearbox_timer_cycles << config.SPI_WORD_LEN) |\
-               (init_value << (config.SPI_WORD_LEN * 2)) |\
-               (max_value << (config.SPI_WORD_LEN * 3))
+        # Sign extended
+        w = dict(self.readback_fields())["revolutions"]
+        if w and res["revolutions"] >> (w - 1):
+            res["revolutions"] -= 1 << w
+
+        return res
+
+    def calculate_write_values(self, previous: int, value: int) -> [int]:
+
+        # Addressed writes (address byte, data byte) updating the bytes that differ between two configuration words
+        n = util.bits_multiple(sum(w for _, w in self.parameter_fields()), multiple_of=config.SPI_WORD_LEN) // 8
+
+        res = []
+        for a in range(n):
+            b = (value >> (a * 8)) & 0xFF
+            if b != (previous >> (a * 8)) & 0xFF:
+                res.append((a << 8) | b)
+
+        # As for the configuration word, an all-ones write is taken as a read
+        assert not self.spi_readback or util.max_for_bits(16) not in res, "the all-ones write is taken as a read"
+
+        return res
+
+    @staticmethod
+    def calculate_command_value(command: int) -> int:
+        return command << 8
 
     def elaborate(self, platform) -> Module:
 
@@ -76,46 +361,127 @@ class Device(Elaboratable):
         # SPI interface and configuration parameters
 
         spi_force_x2 = Signal()
-        m.d.comb += self._decoder.force_x2.eq(self.force_x2 | spi_force_x2)
-
-        # These parameters are part of the same config byte
-        combined_params = Cat(
-            self._gearbox.enable,
-            self._internal_counter.wrap,
-            self._decoder.debounce,
-            self._decoder.x1_value,
-            spi_force_x2)
-
-        assert self._gearbox.timer_cycles.width == 8
-        params = Cat(
-            combined_params,
-            Signal(config.SPI_WORD_LEN - combined_params.shape().width),
-            self._gearbox.timer_cycles,
-            self._internal_counter.init_value,
-            Signal(config.SPI_WORD_LEN - self._internal_counter.init_value.width),
-            self._internal_counter.max_value)
-
-        gbp_sec, gbp_cycles = Gearbox.get_timer_period(*config.GEARBOX_DEFAULT_ENCODER)
-        self.logger.info("period: {:.2f} ms, {} cycles".format(gbp_sec * 1e3, gbp_cycles))
+
+        # The force_x2 pin can request the output snapshot instead
+        output_snapshot = Signal()
+        output_data_ready = Signal(2)
+        output_status = Signal(2)
+
+        m.d.comb += self._decoder.force_x2.eq((self.force_x2 & ~output_snapshot) | spi_force_x2)
+
+        step_exponents = Signal(self.gears * self.STEP_EXPONENT_WIDTH)
+
+        def spi_words(signals: [Signal]):
+            return Cat(*(Cat(s, Signal(config.SPI_WORD_LEN - len(s))) for s in signals))
+
+        param_signals = {
+            "gearbox": self._gearbox.enable,
+            "wrap": self._internal_counter.wrap,
+            "debounce": self._decoder.debounce,
+            "x1_value": self._decoder.x1_value,
+            "force_x2": spi_force_x2,
+            "debounce_window": self._decoder.debounce_window,
+            "gearbox_timer_cycles": self._gearbox.timer_cycles,
+            "init_value": self._internal_counter.init_value,
+            "max_value": self._internal_counter.max_value,
+            "step_exponents": step_exponents,
+            "gearbox_up_thresholds": spi_words(self._gearbox.up_thresholds),
+            "gearbox_down_thresholds": spi_words(self._gearbox.down_thresholds),
+            "gearbox_reset_on_reversal": self._gearbox.reset_on_reversal,
+            "gearbox_idle_periods": self._gearbox.idle_periods,
+            "pwm_sigma_delta": self._pwm_signal.sigma_delta,
+            "uart_baud_increment": self._serial_out.baud_increment,
+            "output_snapshot": output_snapshot,
+            "output_data_ready": output_data_ready,
+            "output_mode": self._parallel_out.mode if self._parallel_out is not None else Signal(2),
+            "output_status": output_status
+        }
+
+        # Signals narrower than their field are padded
+        params = []
+        for name, width in self.parameter_fields():
+            s = param_signals[name] if name is not None else Signal(0)
+            assert len(s) <= width, "{} does not fit the parameter word".format(name)
+            params += [s, Signal(width - len(s))]
+
+        params = Cat(*params)
+
+        self.logger.info("clock: {:.0f} Hz, period: {:.2f} ms, {} cycles".format(
+            self.clock_freq, self.gearbox_period * 1e3, self.gearbox_timer_cycles))
 
         # Parameters are assigned from the SPI buffer "combinationally" below,
         # we need to init the buffer instead of the individual parameters
-        spi_init = self.calculate_parameters_value(
-            debounce=config.DECODER_DEFAULT_DEBOUNCE,
-            wrap=config.DECODER_DEFAULT_WRAP,
-            x1_value=config.DECODER_DEFAULT_X1_VALUE,
-            force_x2=config.DECODER_DEFAULT_FORCE_X2,
-            gearbox=config.GEARBOX_DEFAULT_ENABLED,
-            gearbox_timer_cycles=gbp_cycles,
-            max_value=config.COUNTER_DEFAULT_MAX_VALUE,
-            init_value=config.COUNTER_DEFAULT_VALUE)
+        defaults = {
+            "debounce": config.DECODER_DEFAULT_DEBOUNCE,
+            "wrap": config.DECODER_DEFAULT_WRAP,
+            "x1_value": config.DECODER_DEFAULT_X1_VALUE,
+            "force_x2": config.DECODER_DEFAULT_FORCE_X2,
+            "gearbox": config.GEARBOX_DEFAULT_ENABLED,
+            "gearbox_timer_cycles": self.gearbox_timer_cycles,
+            "max_value": config.COUNTER_DEFAULT_MAX_VALUE,
+            "init_value": config.COUNTER_DEFAULT_VALUE,
+            "debounce_window": config.DECODER_DEFAULT_DEBOUNCE_WINDOW
+        }
+
+        spi_init = self.calculate_parameters_value(**defaults)
+        spi_presets = [self.calculate_parameters_value(**dict(defaults, **p)) for p in self.boot_presets]
 
         self.logger.info("initial parameter values: 0x{:X}".format(spi_init))
+        for i, v in enumerate(spi_presets):
+            self.logger.info("boot preset {}: 0x{:X}".format(i + 1, v))
+
+        readback_width = sum(w for _, w in self.readback_fields()) if self.spi_readback else 0
 
         spi = SPIInputChunked(
-            width=util.bits_multiple(params.shape().width, multiple_of=config.SPI_WORD_LEN), init=spi_init)
+            width=util.bits_multiple(params.shape().width, multiple_of=config.SPI_WORD_LEN), init=spi_init,
+            sync_stages=config.SPI_SYNC_STAGES, readback_width=readback_width, presets=spi_presets)
         m.submodules.spi = spi
 
+        if self.spi_readback:
+
+            assert self.gears <= 1 << TelemetryFrame.GEAR_WIDTH, "too many gears for readback"
+
+            gear = Signal(TelemetryFrame.GEAR_WIDTH)
+            m.d.comb += gear.eq(self._gearbox.gear)
+
+            revolutions = Signal(signed(dict(self.readback_fields())["revolutions"]))
+            if self.revolutions.width:
+                m.d.comb += revolutions.eq(self.revolutions)
+
+            # Saturating event counts, cleared along with the serial output
+            events = []
+            if self.event_counters:
+
+                # The fast decoder may suppress several changes between two cycles
+                suppressed_steps = self._decoder.steps_suppressed if self.decoder_domain is not None else 1
+
+                for event, increment in [
+                        (spi.error, 1),
+                        (self._internal_counter.saturated, 1),
+                        (self._decoder.suppressed, suppressed_steps)]:
+                    count = Signal(self.EVENT_COUNT_WIDTH)
+                    total = Signal(max(count.width, len(Value.cast(increment))) + 1)
+                    m.d.comb += total.eq(count + increment)
+                    with m.If(spi.strobe | spi.write_strobe):
+                        m.d.sync += count.eq(0)
+                    with m.Elif(event):
+                        m.d.sync += count.eq(Mux(total[count.width:].any(), util.max_for_bits(count.width), total))
+                    events.append(count)
+
+            m.d.comb += [
+                spi.readback.eq(Cat(
+                    spi.data,
+                    *events,
+                    self._serial_out.dropped_count,
+                    self._decoder.direction,
+                    gear,
+                    self._serial_out.overflow,
+                    Const(0, 3),
+                    revolutions,
+                    self._internal_counter.value)),
+                self.sdo.eq(spi.sdo)
+            ]
+
         m.d.comb += [
             spi.cs.eq(self.cs),
             spi.sck.eq(self.sck),
@@ -125,14 +491,40 @@ class Device(Elaboratable):
         ]
 
         # Counter
+
+        # Gear 0 applies when the gearbox is disabled
+        gear = Mux(self._gearbox.enable, self._gearbox.gear, 0)
+
+        step = Const(1)
+
+        if self.decoder_domain is not None:
+            # Several steps can be made in a cycle, selected as the gearbox strobe
+            steps = Array([self._decoder.steps_x1, self._decoder.steps_x2] +
+                          [self._decoder.steps_x4] * (self.gears - 2))[gear]
+            step = Mux(steps < 0, -steps, steps)
+            m.d.comb += self._internal_counter.inc.eq(steps >= 0)
+
+        else:
+            m.d.comb += self._internal_counter.inc.eq(self._decoder.direction)
+
+        if self.step_sizes:
+            e = step_exponents.word_select(gear, self.STEP_EXPONENT_WIDTH)
+            step = step << (e << 1)
+
         m.d.comb += [
-            self._internal_counter.inc.eq(self._decoder.direction),
-            self._internal_counter.strobe.eq(~spi.busy & self._gearbox.strobe),
-            self._internal_counter.reset.eq(spi.strobe),
+            self._internal_counter.step.eq(step),
+            # The configuration is committed atomically at the end of a transaction, counting goes on meanwhile
+            self._internal_counter.strobe.eq(self._gearbox.strobe),
+            # Addressed writes keep the count
+            self._internal_counter.reset.eq(
+                spi.strobe | (spi.command_strobe & (spi.address == self.COMMAND_COUNTER_RESET))),
 
             self.counter.eq(self._internal_counter.value)
         ]
 
+        if self.revolutions.width:
+            m.d.comb += self.revolutions.eq(self._internal_counter.revolutions)
+
         # PWM
         m.d.comb += [
             self._pwm_signal.duty.eq(self._internal_counter.value),
@@ -140,11 +532,77 @@ class Device(Elaboratable):
         ]
 
         # UART
+
+        if self.low_latency:
+            # Sent along with the counter update
+            value = Cat(self._internal_counter.next_value, self._internal_counter.next_revolutions)
+        else:
+            value = Cat(self._internal_counter.value, self.revolutions)
+
+        if self._telemetry is not None:
+
+            m.submodules.telemetry = self._telemetry
+
+            # Toggles with each configuration received
+            config_toggle = Signal()
+            with m.If(spi.strobe | spi.write_strobe):
+                m.d.sync += config_toggle.eq(~config_toggle)
+
+            assert self.gears <= 1 << TelemetryFrame.GEAR_WIDTH, "too many gears for telemetry"
+
+            m.d.comb += [
+                self._telemetry.value.eq(value),
+                self._telemetry.direction.eq(self._decoder.direction),
+                self._telemetry.gear.eq(self._gearbox.gear),
+                self._telemetry.flags.eq(Cat(self._gearbox.enable, self._serial_out.overflow, config_toggle)),
+                self._telemetry.strobe.eq(self._internal_counter.updating_strobe)
+            ]
+
+            value = self._telemetry.frame
+
         m.d.comb += [
-            self._serial_out.word.eq(self._internal_counter.value),
-            self._serial_out.strobe.eq(self._internal_counter.updating_strobe)
+            self._serial_out.word.eq(value),
+            self._serial_out.strobe.eq(self._internal_counter.updating_strobe),
+            self._serial_out.clear.eq(spi.strobe | spi.write_strobe)
         ]
 
+        # Output pins
+
+        serial_tx, pwm, direction = self.serial_tx, self.pwm, self.direction
+        counter = self.counter
+
+        if self._parallel_out is not None:
+
+            m.submodules.parallel_out = self._parallel_out
+
+            m.d.comb += [
+                self._parallel_out.value.eq(self._internal_counter.value),
+                self._parallel_out.strobe.eq(self._internal_counter.updating_strobe),
+                self._parallel_out.request.eq(self.force_x2 & output_snapshot)
+            ]
+
+            counter = self._parallel_out.output
+
+            gear = Signal(2)
+            m.d.comb += gear.eq(self._gearbox.gear)
+
+            # Indexed by output_status
+            pwm = Array([pwm, gear[0], gear[0], self.serial_overflow])[output_status]
+            direction = Array([direction, gear[1], direction, direction])[output_status]
+
+            data_ready = self._parallel_out.data_ready
+            serial_tx = Mux(output_data_ready == self.DATA_READY_SERIAL, data_ready, serial_tx)
+            pwm = Mux(output_data_ready == self.DATA_READY_PWM, data_ready, pwm)
+            direction = Mux(output_data_ready == self.DATA_READY_DIRECTION, data_ready, direction)
+
+        counter = counter[0:config.OUTPUT_WIDTH]
+
+        if self.spi_readback:
+            # SDO replaces the counter MSB
+            counter = Cat(counter[:-1], self.sdo)
+
+        m.d.comb += self.outputs.eq(Cat(serial_tx, pwm, direction, counter))
+
         return m
 
 
@@ -199,7 +657,7 @@ class DeviceTestSuite(TestCase):
         yield self.dut.sck.eq(1)
         yield from self.do_wait()
 
-    def send(self, val: int):
+    def transfer(self, val: int, width: int):
 
         # TODO: do it in another clock domain instead and avoid clock aligned transitions
 
@@ -208,8 +666,8 @@ class DeviceTestSuite(TestCase):
         yield from self.do_cs_low()
 
         v = val
-        for _ in range(self.WIDTH):
-            yield self.dut.sdi.eq((v >> (self.WIDTH - 1)) & 1)
+        for _ in range(width):
+            yield self.dut.sdi.eq((v >> (width - 1)) & 1)
             yield from self.do_clock_tick()
             v <<= 1
 
@@ -219,16 +677,896 @@ class DeviceTestSuite(TestCase):
         for _ in range(10):
             yield
 
+    def send(self, val: int):
+
+        yield from self.transfer(val, self.WIDTH)
         yield from self.update_channels([2, 0, 1, 3], repeat=10)
 
     @test_case
     def test_parameters(self):
 
-        yield from self.send(Device.calculate_parameters_value(
+        yield from self.send(self.dut.calculate_parameters_value(
             debounce=True, wrap=False, gearbox=True, force_x2=False,
             x1_value=0, gearbox_timer_cycles=137, max_value=110, init_value=17))
 
 
+class DeviceROMDecoderTestSuite(DeviceTestSuite):
+
+    def instantiate_dut(self):
+        return Device(decoder_backend=GrayCodeDecoder.BACKEND_ROM)
+
+
+class DeviceFastSPITestSuite(DeviceTestSuite):
+
+    def do_wait(self):
+
+        # SCK at its maximum frequency
+        for _ in range(SPIInputChunked.MIN_HALF_PERIOD):
+            yield
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=110, init_value=17))
+
+        # 10 turns of the sequence with X1 updates
+        v = yield self.dut.counter
+        self.assertEqual(v, 27)
+
+
+class DeviceClockEnableTestSuite(DeviceTestSuite):
+
+    # Clock cycles per enabled cycle, as when running from a faster clock than the device is built for
+    DIVIDER = 3
+
+    HOLD_CYCLES = DeviceTestSuite.HOLD_CYCLES * DIVIDER
+
+    def wrap_dut(self, dut):
+
+        m = Module()
+
+        counter = Signal(range(self.DIVIDER))
+        m.d.sync += counter.eq(Mux(counter == self.DIVIDER - 1, 0, counter + 1))
+
+        m.submodules.dev = EnableInserter(counter == 0)(dut)
+
+        return m
+
+    def do_wait(self):
+
+        for _ in range(4 * self.DIVIDER):
+            yield
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=110, init_value=17))
+
+        # 10 turns of the sequence with X1 updates
+        v = yield self.dut.counter
+        self.assertEqual(v, 27)
+
+
+class DeviceAddressedWriteTestSuite(DeviceTestSuite):
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        params = dict(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=110, init_value=17)
+
+        previous = dut.calculate_parameters_value(**params)
+        yield from self.send(previous)
+
+        v = yield dut.counter
+        self.assertEqual(v, 27)
+
+        # Lower maximum with wrap around, the count is kept
+        params.update(wrap=True, max_value=30)
+        writes = dut.calculate_write_values(previous, dut.calculate_parameters_value(**params))
+        self.assertEqual(len(writes), 2)
+
+        for w in writes:
+            yield from self.transfer(w, 16)
+
+        v = yield dut.counter
+        self.assertEqual(v, 27)
+
+        yield from self.update_channels([2, 0, 1, 3], repeat=10)
+
+        v = yield dut.counter
+        self.assertEqual(v, (27 + 10) % 31)
+
+        # Explicit reset
+        yield from self.transfer(dut.calculate_command_value(Device.COMMAND_COUNTER_RESET), 16)
+
+        v = yield dut.counter
+        self.assertEqual(v, 17)
+
+    @test_case
+    def test_lower_max_value(self):
+
+        dut = self.dut
+
+        params = dict(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=110, init_value=17)
+
+        previous = dut.calculate_parameters_value(**params)
+        yield from self.send(previous)
+
+        # Maximum lowered below the count without wrap around, the count is clamped
+        params.update(max_value=20)
+        for w in dut.calculate_write_values(previous, dut.calculate_parameters_value(**params)):
+            yield from self.transfer(w, 16)
+
+        v = yield dut.counter
+        self.assertEqual(v, 20)
+
+        # Saturates at the new maximum
+        counter = yield from self.update_channels([2, 0, 1, 3], repeat=10)
+        self.assertEqual(counter, [20])
+
+        counter = yield from self.update_channels([1, 0, 2, 3], repeat=2)
+        self.assertEqual(counter, [20, 19, 18])
+
+
+class DeviceCountDuringTransferTestSuite(DeviceTestSuite):
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        params = dict(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=110, init_value=17)
+
+        previous = dut.calculate_parameters_value(**params)
+        yield from self.send(previous)
+
+        params.update(gearbox_timer_cycles=80)
+        writes = dut.calculate_write_values(previous, dut.calculate_parameters_value(**params))
+        self.assertEqual(len(writes), 1)
+
+        # Turn the encoder with each SCK tick of the addressed write
+        yield from self.do_cs_low()
+
+        sequence = [2, 0, 1, 3] * 4
+        v = writes[0]
+        for s in sequence:
+            yield dut.channels.eq(s)
+            yield dut.sdi.eq((v >> 15) & 1)
+            yield from self.do_clock_tick()
+            v <<= 1
+
+        yield dut.cs.eq(1)
+        for _ in range(10):
+            yield
+
+        v = yield dut.counter
+        self.assertEqual(v, 27 + 4)
+
+        v = yield dut._gearbox.timer_cycles
+        self.assertEqual(v, 80)
+
+
+class DeviceLatencyTestSuite(DeviceTestSuite):
+
+    LOW_LATENCY = False
+
+    # Cycles from a change of the channels
+    LATENCIES = {"direction": 1, "counter": 2, "serial_tx": 3}
+
+    def instantiate_dut(self):
+        return Device(low_latency=self.LOW_LATENCY)
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        yield from self.send(dut.calculate_parameters_value(
+            debounce=False, wrap=True, gearbox=False, force_x2=True,
+            x1_value=1, gearbox_timer_cycles=62, max_value=255, init_value=0))
+
+        # Serial output idle
+        for _ in range(50):
+            yield
+
+        counter = yield dut.counter
+
+        # Decrement on X2
+        yield dut.channels.eq(1)
+
+        latencies = {}
+        for c in range(8):
+            yield Settle()
+            for name, expected in [("direction", 0), ("counter", counter - 1), ("serial_tx", 0)]:
+                v = yield getattr(dut, name)
+                if name not in latencies and v == expected:
+                    latencies[name] = c
+            yield
+
+        self.assertEqual(latencies, self.LATENCIES)
+
+
+class DeviceLowLatencyTestSuite(DeviceLatencyTestSuite):
+
+    LOW_LATENCY = True
+
+    LATENCIES = {"direction": 0, "counter": 1, "serial_tx": 1}
+
+
+class DeviceParallelOutputTestSuite(DeviceTestSuite):
+
+    WIDTH = 48
+
+    def instantiate_dut(self):
+        return Device(parallel_output=True)
+
+    def outputs(self):
+
+        v = yield self.dut.outputs
+        return v & 0b111, v >> 3
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        yield from self.send(dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=110, init_value=17,
+            output_snapshot=True, output_data_ready=Device.DATA_READY_PWM))
+
+        _, v = yield from self.outputs()
+        self.assertEqual(v, 27 & 0x1F)
+
+        # Request snapshot, the pin does not force X2 updates
+        yield dut.force_x2.eq(1)
+        for _ in range(ParallelOutput.SYNC_STAGES + 2):
+            yield
+
+        data_ready = 0
+        for s in [2, 0, 1, 3] * 2:
+            yield dut.channels.eq(s)
+            for _ in range(self.HOLD_CYCLES):
+                yield
+                pins, v = yield from self.outputs()
+                self.assertEqual(v, 27 & 0x1F)
+                data_ready += (pins >> 1) & 1
+
+        v = yield dut.counter
+        self.assertEqual(v, 29)
+        self.assertEqual(data_ready, 2)
+
+        yield dut.force_x2.eq(0)
+        for _ in range(ParallelOutput.SYNC_STAGES + 2):
+            yield
+
+        _, v = yield from self.outputs()
+        self.assertEqual(v, 29 & 0x1F)
+
+
+class DeviceOutputModesTestSuite(DeviceParallelOutputTestSuite):
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        params = dict(
+            debounce=False, wrap=False, gearbox=True, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=250, init_value=200,
+            output_snapshot=True, output_mode=ParallelOutput.MODE_PAGED,
+            output_status=Device.OUTPUT_STATUS_GEAR)
+        yield from self.send(dut.calculate_parameters_value(**params))
+
+        v = yield dut.counter
+        gear = yield dut._gearbox.gear
+        self.assertNotEqual(gear, 0)
+
+        # Low nibble before any request, gear on PWM and direction
+        pins, c = yield from self.outputs()
+        self.assertEqual(c, v & 0xF)
+        self.assertEqual(pins >> 1, gear)
+
+        # Snapshot with the low nibble marked, then high nibble on the next request while counting
+        for n in range(2):
+            yield dut.force_x2.eq(1)
+            for _ in range(ParallelOutput.SYNC_STAGES + 2):
+                yield
+
+            _, c = yield from self.outputs()
+            self.assertEqual(c, ((v >> (n * 4)) & 0xF) | (int(n == 0) << 4))
+
+            yield from self.update_channels([2, 0, 1, 3])
+
+            yield dut.force_x2.eq(0)
+            for _ in range(ParallelOutput.SYNC_STAGES + 2):
+                yield
+
+        # Released after the high nibble
+        v2 = yield dut.counter
+        self.assertNotEqual(v2, v)
+
+        _, c = yield from self.outputs()
+        self.assertEqual(c, v2 & 0xF)
+
+
+class DeviceWideTestSuite(DeviceTestSuite):
+
+    COUNTER_WIDTH = 16
+    REVOLUTIONS_WIDTH = 8
+
+    WIDTH = 48
+
+    def instantiate_dut(self):
+        return Device(width=self.COUNTER_WIDTH, revolutions_width=self.REVOLUTIONS_WIDTH)
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=True, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=999, init_value=995))
+
+        # 10 turns of the sequence from 995 with X1 updates
+        v = yield self.dut.counter
+        r = yield self.dut.revolutions
+        self.assertEqual((v, r), (5, 1))
+
+
+class DeviceReadbackTestSuite(DeviceWideTestSuite):
+
+    def instantiate_dut(self):
+        return Device(width=self.COUNTER_WIDTH, revolutions_width=self.REVOLUTIONS_WIDTH, spi_readback=True)
+
+    def read(self):
+
+        dut = self.dut
+        width = sum(w for _, w in dut.readback_fields())
+
+        # SDI held high marks a read
+        yield dut.sdi.eq(1)
+        yield from self.do_cs_low()
+        for _ in range(SPIInputChunked.SYNC_STAGES + 2):
+            yield
+
+        # Sample on SCK rising edges, with SCK at the maximum read frequency
+        res = 0
+        for _ in range(width):
+            yield dut.sck.eq(0)
+            for _ in range(SPIInputChunked.SYNC_STAGES + 2):
+                yield
+            v = yield dut.sdo
+            res = (res << 1) | v
+            yield dut.sck.eq(1)
+            for _ in range(SPIInputChunked.SYNC_STAGES + 2):
+                yield
+
+        yield dut.sck.eq(0)
+        yield
+        yield dut.cs.eq(1)
+        yield
+
+        return dut.parse_readback_value(res)
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        params = dut.calculate_parameters_value(
+            debounce=False, wrap=True, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=999, init_value=5)
+        yield from self.send(params)
+
+        # 10 turns of the sequence from 5, then 20 backwards with X1 updates
+        yield from self.update_channels([3, 1, 0, 2], repeat=20)
+
+        dropped_count = yield dut._serial_out.dropped_count
+        gear = yield dut._gearbox.gear
+        overflow = yield dut.serial_overflow
+
+        res = yield from self.read()
+        self.assertEqual(res, {
+            "parameters": params,
+            "dropped_count": dropped_count,
+            "direction": 0,
+            "gear": gear,
+            "serial_overflow": overflow,
+            "revolutions": -1,
+            "counter": 995
+        })
+
+        # Reading does not reset the counter
+        for _ in range(10):
+            yield
+        v = yield dut.counter
+        self.assertEqual(v, 995)
+
+    def test_all_ones(self):
+
+        # Would be dropped as a read
+        with self.assertRaises(AssertionError):
+            self.dut.calculate_parameters_value(
+                debounce=True, wrap=True, gearbox=True, force_x2=True, x1_value=3, debounce_window=3,
+                gearbox_timer_cycles=util.max_for_bits(8), max_value=util.max_for_bits(self.COUNTER_WIDTH),
+                init_value=util.max_for_bits(self.COUNTER_WIDTH))
+
+
+class DeviceEventCountersTestSuite(DeviceReadbackTestSuite):
+
+    def instantiate_dut(self):
+        return Device(
+            width=self.COUNTER_WIDTH, revolutions_width=self.REVOLUTIONS_WIDTH, spi_readback=True, event_counters=True)
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        params = dut.calculate_parameters_value(
+            debounce=True, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=999, init_value=995)
+        yield from self.transfer(params, self.WIDTH)
+
+        # Counts are cleared by the configuration
+        res = yield from self.read()
+        self.assertEqual(
+            (res["spi_error_count"], res["saturated_count"], res["suppressed_count"]), (0, 0, 0))
+
+        # Invalid transaction, 10 turns from 995 with X1 updates and the reversals discarded by the debounce
+        yield from self.transfer(0x5A, 7)
+        yield from self.update_channels([1, 3, 2, 0], repeat=10)
+        yield from self.update_channels([2])
+
+        res = yield from self.read()
+        self.assertEqual(res["counter"], 999)
+        self.assertEqual(
+            (res["spi_error_count"], res["saturated_count"], res["suppressed_count"]), (1, 6, 2))
+
+
+class DeviceStepSizesTestSuite(DeviceTestSuite):
+
+    WIDTH = 40
+
+    def instantiate_dut(self):
+        return Device(step_sizes=True)
+
+    @test_case
+    def test_parameters(self):
+
+        # Gearbox disabled, gear 0 step applies
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=True, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=99, init_value=0,
+            step_exponents=(2, 0, 0)))
+
+        # 10 turns of the sequence with X1 updates
+        v = yield self.dut.counter
+        self.assertEqual(v, (10 * 16) % 100)
+
+
+class DeviceGearboxThresholdsTestSuite(DeviceTestSuite):
+
+    GEARS = 4
+
+    WIDTH = 32 + 8 + 2 * 3 * 8
+
+    def instantiate_dut(self):
+        return Device(step_sizes=True, gears=self.GEARS, gearbox_thresholds=True)
+
+    @test_case
+    def test_parameters(self):
+
+        up = [2, 4, 6]
+        down = [1, 3, 5]
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=True, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=255, max_value=255, init_value=0,
+            step_exponents=(0, 0, 0, 1),
+            gearbox_up_thresholds=up, gearbox_down_thresholds=down))
+
+        for i, (u, d) in enumerate(zip(up, down)):
+            v = yield self.dut._gearbox.up_thresholds[i]
+            self.assertEqual(v, u)
+            v = yield self.dut._gearbox.down_thresholds[i]
+            self.assertEqual(v, d)
+
+        # Top gear is reached quickly with a slow timer, then counts 4 per transition
+        g = yield self.dut._gearbox.gear
+        self.assertEqual(g, self.GEARS - 1)
+
+    def test_parameters_range(self):
+
+        # Each threshold has its own SPI word but only THRESHOLD_WIDTH bits
+        for t in [util.max_for_bits(Gearbox.THRESHOLD_WIDTH) + 1, 256]:
+            with self.assertRaises(AssertionError):
+                self.dut.calculate_parameters_value(
+                    debounce=False, wrap=False, gearbox=True, force_x2=False,
+                    x1_value=0, gearbox_timer_cycles=255, max_value=255, init_value=0,
+                    gearbox_up_thresholds=[2, t, 6], gearbox_down_thresholds=[1, 3, 5])
+
+
+class DeviceGearboxDecayTestSuite(DeviceTestSuite):
+
+    WIDTH = 40
+
+    def instantiate_dut(self):
+        return Device(gearbox_decay=True)
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=True, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=255, max_value=255, init_value=0,
+            gearbox_reset_on_reversal=True, gearbox_idle_periods=3))
+
+        v = yield self.dut._gearbox.reset_on_reversal
+        self.assertTrue(v)
+        v = yield self.dut._gearbox.idle_periods
+        self.assertEqual(v, 3)
+
+        g = yield self.dut._gearbox.gear
+        self.assertEqual(g, Gearbox.GEARS - 1)
+
+        # Back to X1 with the first reversed transition
+        yield from self.update_channels([1])
+        g = yield self.dut._gearbox.gear
+        self.assertEqual(g, 0)
+
+
+class DeviceDebounceWindowTestSuite(DeviceTestSuite):
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=True, wrap=False, gearbox=False, force_x2=True,
+            x1_value=0, gearbox_timer_cycles=62, max_value=255, init_value=100,
+            debounce_window=2))
+
+        v = yield self.dut._decoder.debounce_window
+        self.assertEqual(v, 2)
+
+        # Reversal is not lost (X2 updates)
+        c = yield self.dut.counter
+        counter = yield from self.update_channels([1, 0, 2, 3], repeat=2)
+        self.assertEqual(counter[-1], c - 4)
+
+
+class DeviceUARTFIFOTestSuite(DeviceTestSuite):
+
+    FIFO_DEPTH = 8
+
+    def instantiate_dut(self):
+        return Device(uart_fifo_depth=self.FIFO_DEPTH)
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=255, init_value=0))
+
+        v = yield self.dut.serial_overflow
+        self.assertFalse(v)
+
+        # Faster than the UART with X2 updates
+        yield self.dut.force_x2.eq(1)
+        self.HOLD_CYCLES = 1
+        yield from self.update_channels([2, 0, 1, 3], repeat=3)
+
+        v = yield self.dut.serial_overflow
+        self.assertEqual(v, self.FIFO_DEPTH == 0)
+
+
+class DeviceUARTLatestTestSuite(DeviceUARTFIFOTestSuite):
+
+    FIFO_DEPTH = 0
+
+
+class DeviceTelemetryTestSuite(DeviceTestSuite):
+
+    def instantiate_dut(self):
+        return Device(uart_telemetry=True)
+
+    def receive(self, cycles: int) -> bytes:
+
+        data = []
+
+        bits = None
+        for _ in range(cycles):
+            v = yield self.dut.serial_tx
+            yield
+
+            if bits is None:
+                if not v:
+                    bits = []
+            elif len(bits) < 8:
+                bits.append(v)
+            else:
+                self.assertEqual(v, 1, "missing stop bit")
+                data.append(sum(b << i for i, b in enumerate(bits)))
+                bits = None
+
+        return bytes(data)
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=255, init_value=100))
+
+        # Let the last frame through, then one more step down
+        for _ in range(64):
+            yield
+
+        yield from self.update_channels([1])
+        yield self.dut.channels.eq(0)
+        data = yield from self.receive(64)
+
+        self.assertEqual(len(data), 5)
+        self.assertEqual(data[0], TelemetryFrame.SYNC)
+        self.assertEqual(data[1], 100 + 10 - 1)
+        self.assertEqual(data[2] & 1, 0, "direction should be down")
+        # Updates were dropped during the spin (frames are longer than the time between updates)
+        self.assertEqual(data[2] >> 4, 0b110, "expected overflow, configured once")
+        self.assertEqual(data[3], 10 + 1)
+        self.assertEqual(data[4], util.crc8(data[:4]))
+
+
+class DeviceBaudRateTestSuite(DeviceTestSuite):
+
+    WIDTH = 48
+
+    def instantiate_dut(self):
+        return Device(uart_baudrate=config.CLOCK_FREQ / 2, uart_baudrate_spi=True)
+
+    @test_case
+    def test_parameters(self):
+
+        inc = UARTOutput.get_baud_increment(config.CLOCK_FREQ / 4, config.CLOCK_FREQ)
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=255, init_value=100,
+            uart_baud_increment=inc))
+
+        v = yield self.dut._serial_out.baud_increment
+        self.assertEqual(v, inc)
+
+        # Start bit lasts 4 cycles
+        for _ in range(200):
+            yield
+
+        yield from self.update_channels([1])
+        yield self.dut.channels.eq(0)
+
+        tx = []
+        for _ in range(16):
+            yield
+            v = yield self.dut.serial_tx
+            tx.append(v)
+
+        start = tx.index(0)
+        self.assertEqual(tx[start:start + 5], [0] * 4 + [1], "expected 4 cycles start bit followed by bit 0 of 109")
+
+
+class DeviceClockTestSuite(DeviceTestSuite):
+
+    CLOCK_FREQ = 10e3
+
+    BAUDRATE = 2400
+
+    def instantiate_dut(self):
+        return Device(clock_freq=self.CLOCK_FREQ, uart_baudrate=self.BAUDRATE)
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        fields = dict(dut.parameter_fields())
+        self.WIDTH = sum(w for _, w in dut.parameter_fields())
+
+        # Timer lasts the same time whatever the clock
+        p, c = Gearbox.get_timer_period(*config.GEARBOX_DEFAULT_ENCODER, clock=self.CLOCK_FREQ)
+        self.assertEqual(c, int(round(p * self.CLOCK_FREQ)))
+        self.assertEqual(dut.gearbox_timer_cycles, c)
+        self.assertLessEqual(c, util.max_for_bits(fields["gearbox_timer_cycles"]))
+
+        v = yield dut._gearbox.timer_cycles
+        self.assertEqual(v, c)
+
+        # Baud rate within 1 %
+        self.assertAlmostEqual(
+            UARTOutput.get_baudrate(dut.uart_baud_increment, self.CLOCK_FREQ), self.BAUDRATE, delta=self.BAUDRATE / 100)
+
+        # Debounce windows
+        self.assertEqual(
+            list(dut._decoder.debounce_windows),
+            [int(math.ceil(ms * 1e-3 * self.CLOCK_FREQ)) for ms in config.DECODER_DEBOUNCE_WINDOWS_MS])
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=c, max_value=110, init_value=17))
+
+        # 10 turns of the sequence with X1 updates
+        v = yield dut.counter
+        self.assertEqual(v, 27)
+
+
+class DeviceClockTestSuite2(DeviceClockTestSuite):
+
+    CLOCK_FREQ = 1e6
+
+    BAUDRATE = 115200
+
+
+class DeviceClockTestSuite3(DeviceClockTestSuite):
+
+    CLOCK_FREQ = 12e6
+
+    BAUDRATE = 115200
+
+
+class DeviceBootPresetsTestSuite(DeviceTestSuite):
+
+    PRESETS = (
+        {"debounce": False, "max_value": 110, "init_value": 17},
+        {"debounce": False, "max_value": 20, "init_value": 15, "wrap": True})
+
+    def instantiate_dut(self):
+        return Device(boot_presets=self.PRESETS)
+
+    @test_case
+    def test_parameters(self):
+
+        dut = self.dut
+
+        for select, preset in enumerate(self.PRESETS, start=1):
+
+            yield dut.cs.eq(1)
+            yield dut.sck.eq(select >> 1)
+            yield dut.sdi.eq(select & 1)
+
+            yield self.cd_sync.rst.eq(1)
+            for _ in range(4):
+                yield
+            yield self.cd_sync.rst.eq(0)
+            yield dut.sck.eq(0)
+            yield dut.sdi.eq(0)
+
+            # Counter starts from the preset value without any SPI transfer
+            for _ in range(3):
+                yield
+            v = yield dut.counter
+            self.assertEqual(v, preset["init_value"], "preset {}".format(select))
+
+            yield from self.update_channels([2, 0, 1, 3], repeat=10)
+            v = yield dut.counter
+            self.assertEqual(v, (preset["init_value"] + 10) % (preset["max_value"] + 1), "preset {}".format(select))
+
+
+class DeviceFastDecoderTestSuite(DeviceTestSuite):
+
+    # Decoder clock cycles per clock cycle
+    RATIO = 16
+
+    # Decoder clock cycles each channels value is held
+    FAST_HOLD_CYCLES = 2
+
+    def instantiate_dut(self):
+        return Device(decoder_domain="fast", decoder_clock_freq=config.CLOCK_FREQ * self.RATIO)
+
+    def setUp(self):
+        super().setUp()
+
+        # A full turn takes half a clock cycle
+        self.sequence = add_fast_channels(self.sim, self.dut.channels, self.RATIO, self.FAST_HOLD_CYCLES)
+
+    def do_spin(self, sequence: [int], repeat: int):
+
+        self.sequence += sequence * repeat
+        for _ in range(len(sequence) * repeat * self.FAST_HOLD_CYCLES // self.RATIO + 20):
+            yield
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.transfer(self.dut.calculate_parameters_value(
+            debounce=False, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=self.dut.gearbox_timer_cycles, max_value=110, init_value=17), self.WIDTH)
+
+        # Several X1 updates per clock cycle
+        yield from self.do_spin([1, 3, 2, 0], repeat=10)
+        v = yield self.dut.counter
+        self.assertEqual(v, 27)
+
+        yield from self.do_spin([2, 3, 1, 0], repeat=4)
+        v = yield self.dut.counter
+        self.assertEqual(v, 23)
+
+
+class DeviceFastDecoderEventCountersTestSuite(DeviceEventCountersTestSuite):
+
+    RATIO = DeviceFastDecoderTestSuite.RATIO
+    FAST_HOLD_CYCLES = DeviceFastDecoderTestSuite.FAST_HOLD_CYCLES
+
+    def instantiate_dut(self):
+        return Device(
+            width=self.COUNTER_WIDTH, revolutions_width=self.REVOLUTIONS_WIDTH, spi_readback=True, event_counters=True,
+            decoder_domain="fast", decoder_clock_freq=config.CLOCK_FREQ * self.RATIO)
+
+    def setUp(self):
+        super().setUp()
+
+        self.sequence = add_fast_channels(self.sim, self.dut.channels, self.RATIO, self.FAST_HOLD_CYCLES)
+
+    @test_case
+    def test_bounces(self):
+
+        dut = self.dut
+
+        params = dut.calculate_parameters_value(
+            debounce=True, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=999, init_value=500)
+        yield from self.transfer(params, self.WIDTH)
+
+        # The first change of direction from reset, then bounces within a clock cycle after a turn,
+        # each reversal being discarded by the debounce
+        self.sequence += [1, 3, 2, 0, 1] + [0, 1] * 3
+        for _ in range(20):
+            yield
+
+        res = yield from self.read()
+        self.assertEqual(res["suppressed_count"], 7)
+
+
+class DevicePWMModesTestSuite(DeviceTestSuite):
+
+    WIDTH = 40
+
+    def instantiate_dut(self):
+        return Device(pwm_modes=True)
+
+    @test_case
+    def test_parameters(self):
+
+        yield from self.send(self.dut.calculate_parameters_value(
+            debounce=True, wrap=False, gearbox=False, force_x2=False,
+            x1_value=0, gearbox_timer_cycles=62, max_value=255, init_value=127,
+            pwm_sigma_delta=True))
+
+        v = yield self.dut._pwm_signal.sigma_delta
+        self.assertTrue(v)
+
+        # Toggles at every cycle close to half the maximum value
+        toggles = 0
+        prev = yield self.dut.pwm
+        for _ in range(32):
+            yield
+            v = yield self.dut.pwm
+            toggles += v != prev
+            prev = v
+
+        self.assertGreater(toggles, 16)
+
+
 if __name__ == "__main__":
     logging.root.setLevel(logging.DEBUG)
     unittest.main()
@@ -0,0 +1,235 @@
+import logging
+import math
+import unittest
+
+from amaranth import *
+from amaranth.lib.cdc import FFSynchronizer
+
+import hdl.config as config
+import hdl.util as util
+
+from hdl.gray_code_decoder import GrayCodeDecoder
+from hdl.test_common import TestCase, add_fast_channels, test_case
+
+
+class FastDecoder(Elaboratable):
+
+    """
+    GrayCodeDecoder running in a faster clock domain, with the steps accumulated there and transferred to the
+    sync domain. It can replace GrayCodeDecoder: channels are sampled in the fast domain, the other inputs and
+    all the outputs are in the sync domain.
+
+    A position counter per strobe (X4, X2, X1) is incremented or decremented with each strobe in the fast domain.
+    Positions change by at most 1 per fast cycle, they are transferred as Gray code through synchronizers,
+    so that a single bit changes at a time. The sync domain outputs the signed number of steps since
+    the previous cycle, with strobes asserted when it is not zero. Up to 2^(position_width - 1) - 1 steps
+    can be made between two sync cycles, see get_position_width for a given clock ratio.
+
+    As with GrayCodeDecoder, the channels must be held for at least 2 fast cycles.
+    Configuration inputs are synchronized to the fast domain, they are expected to be quasi-static.
+    The domains can be reset independently: steps are only output from the second cycle after a sync reset.
+
+    Outputs (in addition to those of GrayCodeDecoder):
+        * steps_x4, steps_x2, steps_x1: signed number of steps since the previous cycle
+        * steps_suppressed: number of changes suppressed by the debounce since the previous cycle
+
+    Changes suppressed by the debounce and errors are transferred the same way, suppressed and error being asserted
+    when there was any since the previous cycle.
+
+    """
+
+    POSITION_WIDTH = 8
+
+    def __init__(
+            self,
+            domain: str = "fast",
+            default_debounce: bool = False,
+            debounce_windows: [int] = GrayCodeDecoder.DEFAULT_DEBOUNCE_WINDOWS,
+            position_width: int = POSITION_WIDTH,
+            backend: str = GrayCodeDecoder.BACKEND_LOGIC):
+
+        self.domain = domain
+        self.debounce_windows = debounce_windows
+        self.position_width = position_width
+
+        self._decoder = GrayCodeDecoder(
+            default_debounce=default_debounce, debounce_windows=debounce_windows, backend=backend)
+
+        # Inputs
+
+        self.channels = self._decoder.channels
+        self.debounce = Signal(reset=int(default_debounce))
+        self.debounce_window = Signal(2)
+        self.x1_value = Signal(2)
+        self.force_x2 = Signal()
+
+        # Outputs
+
+        self.direction = Signal()
+        self.strobe_x4 = Signal()
+        self.strobe_x2 = Signal()
+        self.strobe_x1 = Signal()
+        self.suppressed = Signal()
+        self.error = Signal()
+        self.steps_x4 = Signal(signed(position_width))
+        self.steps_x2 = Signal(signed(position_width))
+        self.steps_x1 = Signal(signed(position_width))
+        self.steps_suppressed = Signal(signed(position_width))
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info("domain: {}, position width: {} bits".format(domain, position_width))
+
+    @staticmethod
+    def get_position_width(ratio: float) -> int:
+
+        # Channels held for 2 fast cycles, plus one step as the sync domain samples the positions at any phase
+        steps = int(math.ceil(ratio / 2)) + 1
+
+        return max(FastDecoder.POSITION_WIDTH, util.bits_required(steps) + 1)
+
+    def elaborate(self, platform) -> Module:
+
+        m = Module()
+
+        decoder = self._decoder
+        m.submodules.decoder = DomainRenamer(self.domain)(decoder)
+
+        # Configuration
+
+        for i, o, reset in [
+                (self.debounce, decoder.debounce, self.debounce.reset),
+                (self.debounce_window, decoder.debounce_window, 0),
+                (self.x1_value, decoder.x1_value, 0),
+                (self.force_x2, decoder.force_x2, 0)]:
+            m.submodules += FFSynchronizer(i, o, o_domain=self.domain, reset=reset)
+
+        # Steps become valid once the previous positions were recorded
+        primed = Signal()
+        m.d.sync += primed.eq(1)
+
+        w = self.position_width
+
+        for strobe_fast, inc, strobe, steps in [
+                (decoder.strobe_x4, decoder.direction, self.strobe_x4, self.steps_x4),
+                (decoder.strobe_x2, decoder.direction, self.strobe_x2, self.steps_x2),
+                (decoder.strobe_x1, decoder.direction, self.strobe_x1, self.steps_x1),
+                (decoder.suppressed, 1, self.suppressed, self.steps_suppressed),
+                (decoder.error, 1, self.error, Signal(signed(w)))]:
+
+            position = Signal(w)
+            gray = Signal(w)
+
+            with m.If(strobe_fast):
+                m.d[self.domain] += position.eq(Mux(inc, position + 1, position - 1))
+
+            m.d[self.domain] += gray.eq(position ^ (position >> 1))
+
+            gray_sync = Signal(w)
+            m.submodules += FFSynchronizer(gray, gray_sync)
+
+            position_sync = Signal(w)
+            m.d.comb += position_sync[-1].eq(gray_sync[-1])
+            for b in reversed(range(w - 1)):
+                m.d.comb += position_sync[b].eq(position_sync[b + 1] ^ gray_sync[b])
+
+            last_position = Signal(w)
+            m.d.sync += last_position.eq(position_sync)
+
+            m.d.comb += [
+                steps.eq(Mux(primed, (position_sync - last_position)[:w].as_signed(), 0)),
+                strobe.eq(steps != 0)
+            ]
+
+        # Direction of the last steps
+        direction = Signal()
+        with m.If(self.strobe_x4):
+            m.d.sync += direction.eq(~self.steps_x4[-1])
+
+        m.d.comb += self.direction.eq(Mux(self.strobe_x4, ~self.steps_x4[-1], direction))
+
+        return m
+
+
+#######################################################################################################################
+
+
+class FastDecoderTestSuite(TestCase):
+
+    SEQUENCE_INC = [1, 3, 2, 0]
+    SEQUENCE_DEC = [2, 3, 1, 0]
+
+    # Fast domain cycles per sync cycle
+    RATIO = 8
+
+    # Fast domain cycles each channels value is held, channels change several times per sync cycle
+    FAST_HOLD_CYCLES = 2
+
+    def instantiate_dut(self):
+        return FastDecoder()
+
+    def setUp(self):
+        super().setUp()
+
+        self.sequence = add_fast_channels(self.sim, self.dut.channels, self.RATIO, self.FAST_HOLD_CYCLES)
+
+    def do_spin(self, sequence: [int], cycles: int = 20):
+
+        steps = [0, 0, 0]
+        directions = set()
+
+        self.sequence += sequence
+        for _ in range(cycles):
+            yield
+            for i, s in enumerate([self.dut.steps_x4, self.dut.steps_x2, self.dut.steps_x1]):
+                v = yield s
+                steps[i] += v
+            v = yield self.dut.strobe_x4
+            if v:
+                directions.add((yield self.dut.direction))
+
+        return steps, directions
+
+    @test_case
+    def test(self):
+
+        yield self.dut.channels.eq(0)
+        for _ in range(4):
+            yield
+
+        steps, directions = yield from self.do_spin(self.SEQUENCE_INC * 8)
+        self.assertEqual(steps, [32, 16, 8])
+        self.assertEqual(directions, {1})
+
+        steps, directions = yield from self.do_spin(self.SEQUENCE_DEC * 4)
+        self.assertEqual(steps, [-16, -8, -4])
+        self.assertEqual(directions, {0})
+
+
+class FastDecoderHighRatioTestSuite(FastDecoderTestSuite):
+
+    # More steps per sync cycle than the default position width allows
+    RATIO = 512
+
+    def instantiate_dut(self):
+        return FastDecoder(position_width=FastDecoder.get_position_width(self.RATIO))
+
+    def test_position_width(self):
+
+        self.assertEqual(FastDecoder.get_position_width(8), FastDecoder.POSITION_WIDTH)
+        self.assertEqual(FastDecoder.get_position_width(self.RATIO), 10)
+
+    @test_case
+    def test_many_steps(self):
+
+        yield self.dut.channels.eq(0)
+        for _ in range(4):
+            yield
+
+        steps, directions = yield from self.do_spin(self.SEQUENCE_INC * 80, cycles=4)
+        self.assertEqual(steps, [320, 160, 80])
+        self.assertEqual(directions, {1})
+
+
+if __name__ == "__main__":
+    logging.root.setLevel(logging.DEBUG)
+    unittest.main()
@@ -3,12 +3,13 @@ import unittest
 
 from amaranth import *
 
+from hdl.fast_decoder import FastDecoder
 from hdl.gray_code_decoder import GrayCodeDecoder
 
 import hdl.config as config
 import hdl.util as util
 
-from hdl.test_common import TestCase, test_case
+from hdl.test_common import TestCase, add_fast_channels, test_case
 
 
 class Gearbox(Elaboratable):
@@ -21,23 +22,71 @@ class Gearbox(Elaboratable):
     # Threshold is increased by X4 transition and decreased by a timer
     THRESHOLD_WIDTH = SHIFT + 2
 
-    def __init__(self, decoder: GrayCodeDecoder, default_timer_cycles: int = util.max_for_bits(TIMER_CYCLES_WIDTH - 1)):
+    # X1, X2, X4
+    GEARS = 3
 
-        assert default_timer_cycles <= util.max_for_bits(self.TIMER_CYCLES_WIDTH), "default timer cycles too large"
+    # Timer periods without X4 transition before dropping to the lowest gear
+    IDLE_PERIODS_WIDTH = 7
+
+    def __init__(
+            self,
+            decoder: GrayCodeDecoder,
+            default_timer_cycles: int = util.max_for_bits(TIMER_CYCLES_WIDTH - 1),
+            timer_cycles_width: int = TIMER_CYCLES_WIDTH,
+            gears: int = GEARS,
+            default_up_thresholds: [int] = None,
+            default_down_thresholds: [int] = None,
+            default_reset_on_reversal: bool = False,
+            default_idle_periods: int = 0):
+
+        assert default_timer_cycles <= util.max_for_bits(timer_cycles_width), "default timer cycles too large"
+        assert default_idle_periods <= util.max_for_bits(self.IDLE_PERIODS_WIDTH), "default idle periods too large"
+        assert gears >= 2, "at least two gears are required"
 
         self._decoder = decoder
 
+        self.gears = gears
+
+        # Without hysteresis the gear changes every 2^SHIFT threshold increments
+        if default_up_thresholds is None:
+            default_up_thresholds = self.get_default_thresholds(gears)
+        if default_down_thresholds is None:
+            default_down_thresholds = default_up_thresholds
+
+        assert len(default_up_thresholds) == len(default_down_thresholds) == gears - 1, "expected one threshold per gear change"
+        assert max(list(default_up_thresholds) + list(default_down_thresholds)) <= \
+               util.max_for_bits(self.THRESHOLD_WIDTH), "default thresholds too large"
+
         # Inputs
 
         self.enable = Signal()
-        self.timer_cycles = Signal(self.TIMER_CYCLES_WIDTH, reset=default_timer_cycles)
+        self.timer_cycles = Signal(timer_cycles_width, reset=default_timer_cycles)
+
+        # Gear g + 1 is selected once the threshold reaches up_thresholds[g],
+        # and gear g again when it falls below down_thresholds[g] (which should not be larger)
+        self.up_thresholds = [
+            Signal(self.THRESHOLD_WIDTH, reset=t, name="up_threshold_{}".format(g))
+            for g, t in enumerate(default_up_thresholds)]
+        self.down_thresholds = [
+            Signal(self.THRESHOLD_WIDTH, reset=t, name="down_threshold_{}".format(g))
+            for g, t in enumerate(default_down_thresholds)]
+
+        # Drop to the lowest gear as soon as an X4 transition reverses the direction of the previous one,
+        # or after idle_periods timer periods without X4 transition (0 to disable)
+        self.reset_on_reversal = Signal(reset=int(default_reset_on_reversal))
+        self.idle_periods = Signal(self.IDLE_PERIODS_WIDTH, reset=default_idle_periods)
 
         # Outputs
         self.strobe = Signal()
-        self.gear = Signal(2)
+        self.gear = Signal(range(gears))
+        self.threshold = Signal(self.THRESHOLD_WIDTH)
 
         self.logger = logging.getLogger(self.__class__.__name__)
 
+    @staticmethod
+    def get_default_thresholds(gears: int) -> [int]:
+        return [min((g + 1) << Gearbox.SHIFT, util.max_for_bits(Gearbox.THRESHOLD_WIDTH)) for g in range(gears - 1)]
+
     @staticmethod
     def get_timer_period(detents: int, transitions: int, clock: int = config.CLOCK_FREQ):
 
@@ -52,15 +101,22 @@ class Gearbox(Elaboratable):
         # Solve ((detents * transitions * d) - (d / p)) / f = g for p
         p = 1 / (detents * transitions - g * f / d)
 
-        return p, int(round(p * config.CLOCK_FREQ))
+        return p, int(round(p * clock))
+
+    @staticmethod
+    def get_timer_cycles_width(timer_cycles: int) -> int:
+
+        # Leave room to tune the timer up to 4 times the given number of cycles
+        return max(Gearbox.TIMER_CYCLES_WIDTH, util.bits_required(timer_cycles * 4))
 
     def elaborate(self, platform) -> Module:
 
         m = Module()
 
-        threshold = Signal(self.THRESHOLD_WIDTH)
+        threshold = self.threshold
 
         period = Signal.like(self.timer_cycles)
+        idle = Signal.like(self.idle_periods)
 
         m.d.sync += period.eq(period + 1)
         with m.If(period == self.timer_cycles):
@@ -70,18 +126,65 @@ class Gearbox(Elaboratable):
             with m.If(threshold != 0):
                 m.d.sync += threshold.eq(threshold - 1)
 
-        with m.If(self._decoder.strobe_x4 & ~threshold.all()):
-            m.d.sync += threshold.eq(threshold + 1)
+            with m.If(~idle.all()):
+                m.d.sync += idle.eq(idle + 1)
+
+        # X4 transitions in the cycle, several with FastDecoder
+        if isinstance(self._decoder, FastDecoder):
+            steps = Signal(self._decoder.position_width)
+            m.d.comb += steps.eq(Mux(self._decoder.steps_x4 < 0, -self._decoder.steps_x4, self._decoder.steps_x4))
+        else:
+            steps = self._decoder.strobe_x4
+
+        # Saturates, increments override the timer decrement
+        room = Signal.like(threshold)
+        m.d.comb += room.eq(util.max_for_bits(threshold.width) - threshold)
+
+        with m.If(steps != 0):
+            m.d.sync += threshold.eq(Mux(steps < room, threshold + steps, util.max_for_bits(threshold.width)))
+
+        # Gear changes by one step at most per cycle
+
+        up_thresholds = Array(self.up_thresholds)
+        down_thresholds = Array(self.down_thresholds)
 
-        g = Signal(self.THRESHOLD_WIDTH - self.SHIFT)
-        assert g.width == 2
+        with m.If((self.gear != self.gears - 1) & (threshold >= up_thresholds[self.gear])):
+            m.d.sync += self.gear.eq(self.gear + 1)
 
+        with m.Elif((self.gear != 0) & (threshold < down_thresholds[self.gear - 1])):
+            m.d.sync += self.gear.eq(self.gear - 1)
+
+        # Fast decay, overrides the above
+
+        with m.If(self._decoder.strobe_x4):
+            m.d.sync += idle.eq(0)
+
+        # Direction of the last X4 transition, the decoder direction also follows the changes discarded by the debounce
+        last_direction = Signal()
+        moved = Signal()
+        with m.If(self._decoder.strobe_x4):
+            m.d.sync += [
+                last_direction.eq(self._decoder.direction),
+                moved.eq(1)
+            ]
+
+        reversal = Signal()
+        timeout = Signal()
         m.d.comb += [
-            g.eq(threshold >> self.SHIFT),
-            self.gear.eq(Mux(g[1], 2, g))
+            reversal.eq(self.reset_on_reversal & self._decoder.strobe_x4 & moved &
+                        (self._decoder.direction != last_direction)),
+            # The first transition after idling counts, as it clears idle only on the next cycle
+            timeout.eq((self.idle_periods != 0) & (idle >= self.idle_periods) & ~self._decoder.strobe_x4)
         ]
 
-        a = Array([self._decoder.strobe_x1, self._decoder.strobe_x2, self._decoder.strobe_x4])
+        with m.If(reversal | timeout):
+            m.d.sync += [
+                threshold.eq(0),
+                self.gear.eq(0)
+            ]
+
+        # Gears above X4 only differ by the counter step size
+        a = Array([self._decoder.strobe_x1, self._decoder.strobe_x2] + [self._decoder.strobe_x4] * (self.gears - 2))
         m.d.comb += self.strobe.eq(Mux(self.enable, a[self.gear], self._decoder.strobe_x1))
 
         return m
@@ -132,6 +235,212 @@ class GearboxTestSuite(TestCase):
         self.logger.warning("test is not implemented")
 
 
+class GearboxHysteresisTestSuite(TestCase):
+
+    GEARS = 4
+
+    UP_THRESHOLDS = [4, 8, 12]
+    DOWN_THRESHOLDS = [2, 5, 9]
+
+    class DUT(Elaboratable):
+        def __init__(self, gears: int, up_thresholds: [int], down_thresholds: [int]):
+
+            self.decoder = GrayCodeDecoder()
+            self.gearbox = Gearbox(
+                self.decoder, default_timer_cycles=3, gears=gears,
+                default_up_thresholds=up_thresholds, default_down_thresholds=down_thresholds)
+
+        def elaborate(self, platform) -> Module:
+
+            m = Module()
+
+            m.submodules.decoder = self.decoder
+            m.submodules.gearbox = self.gearbox
+
+            return m
+
+    def instantiate_dut(self):
+        return self.DUT(self.GEARS, self.UP_THRESHOLDS, self.DOWN_THRESHOLDS)
+
+    def do_check_gear(self, prev: (int, int)):
+
+        gear = yield self.dut.gearbox.gear
+        threshold = yield self.dut.gearbox.threshold
+
+        prev_gear, prev_threshold = prev
+
+        # The gear follows the threshold observed on the previous cycle
+        if gear > prev_gear:
+            self.assertEqual(gear, prev_gear + 1)
+            self.assertGreaterEqual(prev_threshold, self.UP_THRESHOLDS[prev_gear])
+        elif gear < prev_gear:
+            self.assertEqual(gear, prev_gear - 1)
+            self.assertLess(prev_threshold, self.DOWN_THRESHOLDS[gear])
+        elif gear < self.GEARS - 1:
+            self.assertLess(prev_threshold, self.UP_THRESHOLDS[gear])
+
+        return gear, threshold
+
+    @test_case
+    def test(self):
+
+        yield self.dut.gearbox.enable.eq(1)
+
+        gears = set()
+        state = (0, 0)
+        s = 0
+
+        # Accelerate then slow down until stopping
+        for hold in [1] * 64 + [2] * 32 + [4] * 16 + [8] * 8 + [16] * 8 + [None] * 8:
+            if hold is not None:
+                yield self.dut.decoder.channels.eq(GearboxTestSuite.SEQUENCE_INC[s % 4])
+                s += 1
+            for _ in range(hold or 8):
+                yield
+                state = yield from self.do_check_gear(state)
+                gears.add(state[0])
+
+        self.assertEqual(gears, set(range(self.GEARS)), "not all gears were selected")
+        self.assertEqual(state[0], 0, "gear did not return to 0 at rest")
+
+
+class GearboxDecayTestSuite(TestCase):
+
+    SEQUENCE_INC = GearboxTestSuite.SEQUENCE_INC
+
+    TIMER_CYCLES = 15
+
+    IDLE_PERIODS = 2
+
+    class DUT(GearboxTestSuite.DUT):
+        def __init__(self, timer_cycles: int):
+
+            self.decoder = GrayCodeDecoder()
+            self.gearbox = Gearbox(self.decoder, default_timer_cycles=timer_cycles)
+
+    def instantiate_dut(self):
+        return self.DUT(self.TIMER_CYCLES)
+
+    def do_spin(self, sequence: [int], repeat: int):
+
+        for s in sequence * repeat:
+            yield self.dut.decoder.channels.eq(s)
+            yield
+            yield
+
+        yield
+
+    def do_accelerate(self):
+
+        yield self.dut.gearbox.enable.eq(1)
+        yield from self.do_spin(self.SEQUENCE_INC, 8)
+
+        g = yield self.dut.gearbox.gear
+        self.assertEqual(g, Gearbox.GEARS - 1)
+
+    @test_case
+    def test_reversal(self):
+
+        yield self.dut.gearbox.reset_on_reversal.eq(1)
+        yield from self.do_accelerate()
+
+        yield from self.do_spin(list(reversed(self.SEQUENCE_INC)), 1)
+
+        # The reversal dropped the gear, a single turn cannot bring it back to the top
+        g = yield self.dut.gearbox.gear
+        self.assertNotEqual(g, Gearbox.GEARS - 1)
+
+    @test_case
+    def test_reversal_bounce(self):
+
+        yield self.dut.decoder.debounce.eq(1)
+        yield self.dut.gearbox.reset_on_reversal.eq(1)
+        yield from self.do_accelerate()
+
+        # A bounce discarded by the debounce is not a reversal
+        yield from self.do_spin([self.SEQUENCE_INC[-2], self.SEQUENCE_INC[-1]], 1)
+
+        g = yield self.dut.gearbox.gear
+        t = yield self.dut.gearbox.threshold
+        self.assertEqual(g, Gearbox.GEARS - 1)
+        self.assertNotEqual(t, 0)
+
+    @test_case
+    def test_reversal_disabled(self):
+
+        yield from self.do_accelerate()
+
+        yield from self.do_spin(list(reversed(self.SEQUENCE_INC)), 1)
+
+        g = yield self.dut.gearbox.gear
+        self.assertEqual(g, Gearbox.GEARS - 1)
+
+    @test_case
+    def test_idle(self):
+
+        yield self.dut.gearbox.idle_periods.eq(self.IDLE_PERIODS)
+        yield from self.do_accelerate()
+
+        for _ in range((self.IDLE_PERIODS + 1) * (self.TIMER_CYCLES + 1)):
+            yield
+
+        g = yield self.dut.gearbox.gear
+        t = yield self.dut.gearbox.threshold
+        self.assertEqual((g, t), (0, 0))
+
+    @test_case
+    def test_idle_first_step(self):
+
+        yield self.dut.gearbox.idle_periods.eq(self.IDLE_PERIODS)
+        yield from self.do_accelerate()
+
+        for _ in range((self.IDLE_PERIODS + 1) * (self.TIMER_CYCLES + 1)):
+            yield
+
+        # The first transition after the timeout increments the threshold
+        yield from self.do_spin(self.SEQUENCE_INC[:1], 1)
+
+        t = yield self.dut.gearbox.threshold
+        self.assertEqual(t, 1)
+
+
+class GearboxFastDecoderTestSuite(TestCase):
+
+    SEQUENCE_INC = GearboxTestSuite.SEQUENCE_INC
+
+    # Decoder clock cycles per clock cycle, and each channels value is held
+    RATIO = 8
+    FAST_HOLD_CYCLES = 2
+
+    class DUT(GearboxTestSuite.DUT):
+        def __init__(self):
+
+            self.decoder = FastDecoder()
+            self.gearbox = Gearbox(self.decoder, default_timer_cycles=util.max_for_bits(Gearbox.TIMER_CYCLES_WIDTH))
+
+    def instantiate_dut(self):
+        return self.DUT()
+
+    def setUp(self):
+        super().setUp()
+
+        self.sequence = add_fast_channels(self.sim, self.dut.decoder.channels, self.RATIO, self.FAST_HOLD_CYCLES)
+
+    @test_case
+    def test(self):
+
+        for _ in range(4):
+            yield
+
+        # Several X4 transitions per clock cycle all count
+        self.sequence += self.SEQUENCE_INC * 4
+        for _ in range(10):
+            yield
+
+        t = yield self.dut.gearbox.threshold
+        self.assertEqual(t, 16)
+
+
 if __name__ == "__main__":
     config.DEBUG = True
     unittest.main()
@@ -2,18 +2,114 @@ import unittest
 import numpy as np
 
 from amaranth import *
+from amaranth.sim import Settle
+
+import hdl.util as util
 
 from hdl.test_common import TestCase, test_case
 
 
+class TransitionDecoder(Elaboratable):
+
+    """
+    Change, direction and error of a transition between two values of the channels, computed with logic
+    or looked up in a ROM indexed by the previous and current channels. Combinational, shared by GrayCodeDecoder
+    and DecoderBank.
+    """
+
+    BACKEND_LOGIC = "logic"
+    BACKEND_ROM = "rom"
+
+    def __init__(self, backend: str = BACKEND_LOGIC):
+
+        assert backend in (self.BACKEND_LOGIC, self.BACKEND_ROM), "unsupported backend {}".format(backend)
+
+        self.backend = backend
+
+        # Inputs
+        self.channels = Signal(2)
+        self.prev_channels = Signal(2)
+
+        # Outputs
+        self.changed = Signal()
+        # Incrementing
+        self.direction = Signal()
+        # Both channels changed at once
+        self.error = Signal()
+
+    @staticmethod
+    def get_transitions() -> [int]:
+
+        # Indexed by Cat(channels, previous channels): change (bit 0), direction (bit 1), error (bit 2)
+        res = []
+        for prev in range(4):
+            for cur in range(4):
+                res.append(int(cur != prev) | (((cur ^ (prev >> 1)) & 1) << 1) | (int(cur ^ prev == 3) << 2))
+
+        return res
+
+    @staticmethod
+    def get_update_strobes(strobe_x4, channels, x1_value, force_x2) -> (Value, Value):
+
+        # X2 and X1 strobes of a change to channels, X1 updates forced to X2 with force_x2
+        strobe_x2 = strobe_x4 & ((channels == x1_value) | (channels == ~x1_value))
+        strobe_x1 = Mux(force_x2, strobe_x2, strobe_x4 & (channels == x1_value))
+
+        return strobe_x2, strobe_x1
+
+    def elaborate(self, platform) -> Module:
+
+        m = Module()
+
+        if self.backend == self.BACKEND_ROM:
+            rom = Memory(width=3, depth=16, init=self.get_transitions())
+            m.submodules.rom = rom_rd = rom.read_port(domain="comb")
+            m.d.comb += [
+                rom_rd.addr.eq(Cat(self.channels, self.prev_channels)),
+                Cat(self.changed, self.direction, self.error).eq(rom_rd.data)
+            ]
+
+        else:
+            m.d.comb += [
+                self.changed.eq(self.channels != self.prev_channels),
+                self.direction.eq(self.channels[0] ^ self.prev_channels[1]),
+                self.error.eq((self.channels ^ self.prev_channels).all())
+            ]
+
+        return m
+
+
 class GrayCodeDecoder(Elaboratable):
 
-    def __init__(self, default_debounce: bool = False):
+    # Debounce window (in cycles) selected by debounce_window 1 to 3, 0 keeps the direction based debounce
+    DEFAULT_DEBOUNCE_WINDOWS = (2, 4, 8)
+
+    # See TransitionDecoder
+    BACKEND_LOGIC = TransitionDecoder.BACKEND_LOGIC
+    BACKEND_ROM = TransitionDecoder.BACKEND_ROM
+
+    def __init__(
+            self,
+            default_debounce: bool = False,
+            debounce_windows: [int] = DEFAULT_DEBOUNCE_WINDOWS,
+            comb_strobe: bool = False,
+            backend: str = BACKEND_LOGIC):
+
+        assert len(debounce_windows) == 3, "expected 3 debounce windows"
+
+        self.backend = backend
+        self._transition = TransitionDecoder(backend)
+
+        self.debounce_windows = debounce_windows
+        # Strobes and direction follow the channels in the same cycle instead of the next one,
+        # channels are then expected to be synchronous to the clock
+        self.comb_strobe = comb_strobe
 
         # Inputs
 
         self.channels = Signal(2)
         self.debounce = Signal(reset=int(default_debounce))
+        self.debounce_window = Signal(2)
         self.x1_value = Signal(2)
         self.force_x2 = Signal()
 
@@ -23,6 +119,10 @@ class GrayCodeDecoder(Elaboratable):
         self.strobe_x4 = Signal()
         self.strobe_x2 = Signal()
         self.strobe_x1 = Signal()
+        # A change of the channels was discarded by the debounce, along with the strobes
+        self.suppressed = Signal()
+        # Both channels changed at once (missed transition), the change is strobed with an arbitrary direction
+        self.error = Signal()
 
     def elaborate(self, platform) -> Module:
 
@@ -30,26 +130,90 @@ class GrayCodeDecoder(Elaboratable):
 
         prev_channels = Signal(self.channels.shape(), reset_less=True)
 
-        dir = Signal()
-        m.d.comb += dir.eq(self.channels[0] ^ prev_channels[1])
+        # Direction of the last accepted change
+        direction = Signal()
 
+        m.submodules.transition = transition = self._transition
         m.d.comb += [
-            self.strobe_x2.eq(self.strobe_x4 & ((self.channels == self.x1_value) | (self.channels == ~self.x1_value))),
-            self.strobe_x1.eq(Mux(self.force_x2, self.strobe_x2, (self.strobe_x4 & (self.channels == self.x1_value))))
+            transition.channels.eq(self.channels),
+            transition.prev_channels.eq(prev_channels)
         ]
 
-        m.d.sync += self.strobe_x4.eq(0)
+        changed = transition.changed
+        dir = transition.direction
+        error = transition.error
 
-        with m.If(self.channels != prev_channels):
-            m.d.sync += [
+        # Time based debounce: a change of direction is only accepted once the channels have been stable
+        # for the window, which shrinks to half the interval between the last two transitions in the same direction.
+        # Bouncing contacts produce such changes, whereas transitions in the same direction are never delayed.
+
+        timed = Signal()
+        m.d.comb += timed.eq(self.debounce & (self.debounce_window != 0))
+
+        # Intervals saturate, as after a long time without transition
+        interval = Signal(util.bits_required(max(self.debounce_windows)) + 2)
+        interval.reset = util.max_for_bits(interval.width)
+        last_interval = Signal.like(interval)
+
+        base_window = Signal.like(interval)
+        window = Signal.like(interval)
+        m.d.comb += [
+            base_window.eq(Array(Const(w, interval.width) for w in (0,) + tuple(self.debounce_windows))[self.debounce_window]),
+            window.eq(Mux((last_interval >> 1) < base_window, last_interval >> 1, base_window))
+        ]
+
+        with m.If(~interval.all()):
+            m.d.sync += interval.eq(interval + 1)
+
+        accept = Signal()
+        m.d.comb += accept.eq(changed & ~(timed & (dir != direction) & (interval < window)))
+
+        # Channels of the strobed change: the accepted ones once registered, as the channels may have changed since
+        channels = self.channels if self.comb_strobe else prev_channels
 
+        strobe_x2, strobe_x1 = TransitionDecoder.get_update_strobes(self.strobe_x4, channels, self.x1_value, self.force_x2)
+        m.d.comb += [
+            self.strobe_x2.eq(strobe_x2),
+            self.strobe_x1.eq(strobe_x1)
+        ]
+
+        # Without time based debouncing we just discard the first change of direction
+        strobe = Signal()
+        m.d.comb += strobe.eq(accept & ((dir == direction) | ~self.debounce | timed))
+
+        with m.If(accept):
+            m.d.sync += [
                 prev_channels.eq(self.channels),
-                self.direction.eq(dir),
+                direction.eq(dir),
+                interval.eq(0)
+            ]
+
+            with m.If(dir == direction):
+                m.d.sync += last_interval.eq(interval)
+
+        # Changes held back by the time based debounce are only counted when the channels change
+        last_channels = Signal(self.channels.shape(), reset_less=True)
+        m.d.sync += last_channels.eq(self.channels)
 
-                # For debouncing we just discard the first change of direction
-                self.strobe_x4.eq((dir == self.direction) | ~self.debounce)
+        suppressed = Signal()
+        m.d.comb += suppressed.eq(Mux(accept, ~strobe, changed & (self.channels != last_channels)))
+
+        if self.comb_strobe:
+            m.d.comb += [
+                self.strobe_x4.eq(strobe),
+                self.direction.eq(Mux(accept, dir, direction)),
+                self.suppressed.eq(suppressed),
+                self.error.eq(accept & error)
             ]
 
+        else:
+            m.d.sync += [
+                self.strobe_x4.eq(strobe),
+                self.suppressed.eq(suppressed),
+                self.error.eq(accept & error)
+            ]
+            m.d.comb += self.direction.eq(direction)
+
         with m.If(ResetSignal("sync")):
             m.d.sync += prev_channels.eq(self.channels)
 
@@ -65,6 +229,9 @@ class GrayCodeDecoderTestSuite(TestCase):
 
     FORCE_X2 = False
 
+    # Cycles from a change of the channels to the strobes
+    LATENCY = 1
+
     def instantiate_dut(self):
         return GrayCodeDecoder()
 
@@ -80,24 +247,211 @@ class GrayCodeDecoderTestSuite(TestCase):
             for s in self.SEQUENCE_INC:
 
                 yield self.dut.channels.eq(s)
-                yield
-                yield
+                for _ in range(self.LATENCY):
+                    yield
+                yield Settle()
 
                 s1 = yield self.dut.strobe_x1
                 s2 = yield self.dut.strobe_x2
                 s4 = yield self.dut.strobe_x4
                 result += [s1, s2, s4]
 
+                yield
+
                 assert not s1 or s == x or (self.FORCE_X2 & (s == (~x & 3))), "X1 strobe on incorrect value"
                 assert not s2 or s == x or s == (~x & 3), "X2 strobe on incorrect value"
 
             assert np.array_equal(result, [2 if self.FORCE_X2 else 1, 2, 4]), "unexpected number of strobes for X4"
 
+    @test_case
+    def test_fast(self):
+
+        yield self.dut.force_x2.eq(self.FORCE_X2)
+        yield self.dut.channels.eq(self.SEQUENCE_INC[-1])
+        yield
+        yield
+
+        # Channels changing every cycle, the strobes are qualified with the channels of the strobed change
+        result = np.zeros(3)
+        for s in self.SEQUENCE_INC * 2 + [None] * 2:
+            if s is not None:
+                yield self.dut.channels.eq(s)
+            yield Settle()
+
+            for i, strobe in enumerate([self.dut.strobe_x1, self.dut.strobe_x2, self.dut.strobe_x4]):
+                result[i] += yield strobe
+            yield
+
+        self.assertEqual(list(result), [4 if self.FORCE_X2 else 2, 4, 8])
+
+
+class GrayCodeDecoderSuppressedTestSuite(TestCase):
+
+    BACKEND = GrayCodeDecoder.BACKEND_LOGIC
+
+    def instantiate_dut(self):
+        return GrayCodeDecoder(default_debounce=True, backend=self.BACKEND)
+
+    def count(self, sequence: [int], hold: int):
+
+        strobes = 0
+        suppressed = 0
+        for s in sequence:
+            yield self.dut.channels.eq(s)
+            for _ in range(hold):
+                yield
+                strobes += yield self.dut.strobe_x4
+                suppressed += yield self.dut.suppressed
+
+        return strobes, suppressed
+
+    @test_case
+    def test_suppressed(self):
+
+        yield from self.count([1, 3], hold=16)
+
+        # Direction based debounce discards the first change of direction
+        res = yield from self.count([1, 0, 2], hold=16)
+        self.assertEqual(res, (2, 1))
+
+        # Time based debounce holds back changes of direction within the window, each bounce is counted once
+        yield self.dut.debounce_window.eq(3)
+        res = yield from self.count([0, 2, 0, 2, 0, 0], hold=1)
+        self.assertEqual(res, (1, 2))
+
+    @test_case
+    def test_error(self):
+
+        errors = []
+        for s in [1, 3, 0, 2, 1]:
+            yield self.dut.channels.eq(s)
+            yield
+            yield Settle()
+            v = yield self.dut.error
+            errors.append(v)
+
+        # 3 -> 0 and 2 -> 1 change both channels
+        self.assertEqual(errors, [0, 0, 1, 0, 1])
+
+
+class GrayCodeDecoderROMTestSuite(GrayCodeDecoderTestSuite):
+
+    def instantiate_dut(self):
+        return GrayCodeDecoder(backend=GrayCodeDecoder.BACKEND_ROM)
+
+
+class GrayCodeDecoderROMSuppressedTestSuite(GrayCodeDecoderSuppressedTestSuite):
+
+    BACKEND = GrayCodeDecoder.BACKEND_ROM
+
 
 class GrayCodeDecoderTestSuiteForceX2(GrayCodeDecoderTestSuite):
 
     FORCE_X2 = True
 
 
+class GrayCodeDecoderCombStrobeTestSuite(GrayCodeDecoderTestSuite):
+
+    LATENCY = 0
+
+    def instantiate_dut(self):
+        return GrayCodeDecoder(comb_strobe=True)
+
+    @test_case
+    def test_latency(self):
+
+        yield self.dut.channels.eq(self.SEQUENCE_INC[-1])
+        yield
+        yield
+
+        # Strobe and direction in the same cycle as the change
+        for d, sequence in [(1, self.SEQUENCE_INC), (0, list(reversed(self.SEQUENCE_INC)))]:
+            for s in sequence[1:]:
+                yield self.dut.channels.eq(s)
+                yield Settle()
+                s4 = yield self.dut.strobe_x4
+                v = yield self.dut.direction
+                self.assertEqual((s4, v), (1, d))
+
+                yield
+                yield Settle()
+                s4 = yield self.dut.strobe_x4
+                self.assertEqual(s4, 0)
+
+
+class GrayCodeDecoderDebounceTestSuite(TestCase):
+
+    SEQUENCE_INC = GrayCodeDecoderTestSuite.SEQUENCE_INC
+    SEQUENCE_DEC = [2, 3, 1, 0]
+
+    DEBOUNCE_WINDOW = 3
+
+    SLOW_HOLD_CYCLES = 32
+
+    def instantiate_dut(self):
+        return GrayCodeDecoder(default_debounce=True)
+
+    def do_transitions(self, sequence: [int], hold: int, bounces: int = 0):
+
+        strobes = 0
+
+        for s in sequence:
+
+            # Bounce between the new and the previous value before settling
+            prev = yield self.dut.channels
+            for _ in range(bounces):
+                for v in [s, prev]:
+                    yield self.dut.channels.eq(v)
+                    yield
+                    strobes += yield self.dut.strobe_x4
+
+            yield self.dut.channels.eq(s)
+            for _ in range(hold):
+                yield
+                strobes += yield self.dut.strobe_x4
+
+        # Strobe of the last transition
+        yield
+        strobes += yield self.dut.strobe_x4
+
+        return strobes
+
+    def do_check(self, sequence: [int], hold: int, bounces: int = 0, expected_direction: int = 1):
+
+        strobes = yield from self.do_transitions(sequence, hold, bounces)
+        self.assertEqual(strobes, len(sequence))
+
+        d = yield self.dut.direction
+        self.assertEqual(d, expected_direction)
+
+    @test_case
+    def test_slow_bouncy(self):
+
+        yield self.dut.debounce_window.eq(self.DEBOUNCE_WINDOW)
+        yield self.dut.channels.eq(self.SEQUENCE_INC[-1])
+        yield from self.do_transitions(self.SEQUENCE_INC, self.SLOW_HOLD_CYCLES)
+
+        yield from self.do_check(self.SEQUENCE_INC * 4, self.SLOW_HOLD_CYCLES, bounces=2)
+
+    @test_case
+    def test_fast(self):
+
+        yield self.dut.debounce_window.eq(self.DEBOUNCE_WINDOW)
+        yield self.dut.channels.eq(self.SEQUENCE_INC[-1])
+
+        yield from self.do_check(self.SEQUENCE_INC * 8, 1)
+
+    @test_case
+    def test_reversal(self):
+
+        yield self.dut.debounce_window.eq(self.DEBOUNCE_WINDOW)
+        yield self.dut.channels.eq(self.SEQUENCE_INC[-1])
+        yield from self.do_transitions(self.SEQUENCE_INC, self.SLOW_HOLD_CYCLES)
+
+        # Every transition counts, including the first one in the opposite direction
+        yield from self.do_check(self.SEQUENCE_DEC, self.SLOW_HOLD_CYCLES, expected_direction=0)
+        yield from self.do_check(self.SEQUENCE_INC, self.SLOW_HOLD_CYCLES)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,277 @@
+import logging
+import unittest
+
+from amaranth import *
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.sim import Settle
+
+from hdl.test_common import TestCase, test_case
+
+
+class ParallelOutput(Elaboratable):
+
+    """
+    Parallel output of the counter value, with a snapshot frozen on request.
+
+    While request is high, the output holds the value it had when the request was seen, so that a host can sample
+    all the pins without reading a value being updated. The request is asynchronous, it goes through synchronizers:
+    the output is frozen SYNC_STAGES + 1 cycles after the request was raised, and it follows the value again
+    as many cycles after the request was released.
+
+    The value (or snapshot) is output according to mode:
+        * MODE_DIRECT: least significant bits
+        * MODE_PAGED: one nibble per request on the 4 least significant bits, from the least significant;
+          the next bit marks the first nibble (only once frozen)
+        * MODE_NIBBLE_SERIAL: while frozen, one nibble per cycle from the least significant, looping over the value;
+          the next bit marks the first nibble (only once frozen)
+
+    In paged mode, the snapshot is held across the requests until that of the last nibble is released: the first
+    request takes the snapshot and shows the first nibble, each following one shows the next nibble.
+
+    Inputs:
+        * value: counter value
+        * strobe: value is updated on next cycle
+        * request: freeze the output
+        * mode: see above
+
+    Outputs:
+        * output: value or snapshot
+        * data_ready: 1 cycle pulse along with each value update, including while the output is frozen
+
+    """
+
+    SYNC_STAGES = 2
+
+    MODE_DIRECT = 0
+    MODE_PAGED = 1
+    MODE_NIBBLE_SERIAL = 2
+
+    NIBBLE_WIDTH = 4
+    PAGE_WIDTH = 3
+
+    def __init__(self, width: int, output_width: int):
+
+        assert output_width > self.NIBBLE_WIDTH, "output too narrow for nibbles"
+        assert width <= self.NIBBLE_WIDTH << self.PAGE_WIDTH, "too many nibbles"
+
+        self.nibbles = -(-width // self.NIBBLE_WIDTH)
+
+        # Inputs
+        self.value = Signal(width)
+        self.strobe = Signal()
+        self.request = Signal()
+        self.mode = Signal(2)
+
+        # Outputs
+        self.output = Signal(output_width)
+        self.data_ready = Signal()
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def elaborate(self, platform) -> Module:
+
+        m = Module()
+
+        request = Signal()
+        m.submodules.request_sync = FFSynchronizer(self.request, request, stages=self.SYNC_STAGES)
+
+        # Nibble shown in paged mode, advanced by each request while the snapshot is held
+        page = Signal(range(self.nibbles))
+        paging = Signal()
+
+        request_prev = Signal()
+        m.d.sync += request_prev.eq(request)
+
+        # Release of the last nibble request
+        release = Signal()
+        m.d.comb += release.eq(~request & request_prev & (page == self.nibbles - 1))
+
+        with m.If(self.mode != self.MODE_PAGED):
+            m.d.sync += [
+                page.eq(0),
+                paging.eq(0)
+            ]
+
+        with m.Elif(request & ~request_prev):
+            with m.If(paging):
+                m.d.sync += page.eq(page + 1)
+            with m.Else():
+                m.d.sync += paging.eq(1)
+
+        with m.Elif(release):
+            m.d.sync += [
+                page.eq(0),
+                paging.eq(0)
+            ]
+
+        frozen = Signal()
+        snapshot = Signal.like(self.value)
+
+        m.d.sync += frozen.eq(request | (paging & ~release))
+
+        with m.If(~frozen):
+            m.d.sync += snapshot.eq(self.value)
+
+        value = Signal.like(self.value)
+        m.d.comb += value.eq(Mux(frozen, snapshot, self.value))
+
+        # Value padded to whole nibbles
+        nibbles = Cat(value, Const(0, self.nibbles * self.NIBBLE_WIDTH - len(value)))
+
+        # Nibble shown in serial mode, restarts with each request
+        index = Signal(range(self.nibbles))
+
+        with m.If(~frozen | (index == self.nibbles - 1)):
+            m.d.sync += index.eq(0)
+        with m.Else():
+            m.d.sync += index.eq(index + 1)
+
+        with m.Switch(self.mode):
+
+            with m.Case(self.MODE_PAGED):
+                m.d.comb += self.output.eq(Cat(nibbles.word_select(page, self.NIBBLE_WIDTH), frozen & (page == 0)))
+
+            with m.Case(self.MODE_NIBBLE_SERIAL):
+                m.d.comb += self.output.eq(Cat(nibbles.word_select(index, self.NIBBLE_WIDTH), frozen & (index == 0)))
+
+            with m.Default():
+                m.d.comb += self.output.eq(value)
+
+        # Value is updated on the cycle following the strobe
+        m.d.sync += self.data_ready.eq(self.strobe)
+
+        return m
+
+
+#######################################################################################################################
+
+
+class ParallelOutputTestSuite(TestCase):
+
+    WIDTH = 8
+    OUTPUT_WIDTH = 5
+
+    def instantiate_dut(self):
+        return ParallelOutput(width=self.WIDTH, output_width=self.OUTPUT_WIDTH)
+
+    def do_update(self, value: int):
+
+        yield self.dut.strobe.eq(1)
+        yield
+        yield self.dut.strobe.eq(0)
+        yield self.dut.value.eq(value)
+        yield Settle()
+
+        v = yield self.dut.data_ready
+        self.assertEqual(v, 1)
+
+        yield
+        yield Settle()
+
+        v = yield self.dut.data_ready
+        self.assertEqual(v, 0)
+
+    @test_case
+    def test(self):
+
+        dut = self.dut
+
+        yield from self.do_update(0x12)
+
+        v = yield dut.output
+        self.assertEqual(v, 0x12 & 0x1F)
+
+        yield dut.request.eq(1)
+        for _ in range(ParallelOutput.SYNC_STAGES + 1):
+            yield
+
+        # Frozen while the value keeps being updated
+        yield from self.do_update(0x34)
+
+        v = yield dut.output
+        self.assertEqual(v, 0x12 & 0x1F)
+
+        yield dut.request.eq(0)
+        for _ in range(ParallelOutput.SYNC_STAGES + 1):
+            yield
+        yield Settle()
+
+        v = yield dut.output
+        self.assertEqual(v, 0x34 & 0x1F)
+
+
+class ParallelOutputModesTestSuite(TestCase):
+
+    WIDTH = 16
+    OUTPUT_WIDTH = 5
+
+    VALUE = 0xA5C3
+
+    def instantiate_dut(self):
+        return ParallelOutput(width=self.WIDTH, output_width=self.OUTPUT_WIDTH)
+
+    def do_request(self, request: int):
+
+        yield self.dut.request.eq(request)
+        for _ in range(ParallelOutput.SYNC_STAGES + 1):
+            yield
+        yield Settle()
+
+        v = yield self.dut.output
+        return v
+
+    @test_case
+    def test_paged(self):
+
+        dut = self.dut
+
+        yield dut.value.eq(self.VALUE)
+        yield dut.mode.eq(ParallelOutput.MODE_PAGED)
+
+        # Nibbles of the same snapshot, one per request, while the value changes
+        for p in range(self.WIDTH // 4):
+            v = yield from self.do_request(1)
+            self.assertEqual(v, ((self.VALUE >> (p * 4)) & 0xF) | (int(p == 0) << 4))
+
+            yield dut.value.eq(p)
+            v = yield from self.do_request(0)
+            if p < self.WIDTH // 4 - 1:
+                self.assertEqual(v & 0xF, (self.VALUE >> (p * 4)) & 0xF)
+
+        # Released after the last nibble
+        self.assertEqual(v, self.WIDTH // 4 - 1)
+
+    @test_case
+    def test_nibble_serial(self):
+
+        dut = self.dut
+
+        yield dut.value.eq(self.VALUE)
+        yield dut.mode.eq(ParallelOutput.MODE_NIBBLE_SERIAL)
+        yield dut.request.eq(1)
+
+        # Wait for the first nibble marker, then read a nibble per cycle
+        for c in range(ParallelOutput.SYNC_STAGES + 2):
+            yield
+            yield Settle()
+            v = yield dut.output
+            if v >> 4:
+                break
+
+        self.assertEqual(c, ParallelOutput.SYNC_STAGES)
+
+        value = 0
+        for n in range(2 * self.WIDTH // 4):
+            v = yield dut.output
+            self.assertEqual(v >> 4, int(n % (self.WIDTH // 4) == 0))
+            if n < self.WIDTH // 4:
+                value |= (v & 0xF) << (n * 4)
+            yield
+            yield Settle()
+
+        self.assertEqual(value, self.VALUE)
+
+
+if __name__ == "__main__":
+    logging.root.setLevel(logging.DEBUG)
+    unittest.main()
@@ -16,17 +16,20 @@ class PWMSignal(Elaboratable):
         * duty: current duty cycle.
             The output is constantly low for 0, otherwise high for duty+1 cycles.
         * max_duty: maximum duty cycle.
+        * sigma_delta: first-order sigma-delta modulation instead of PWM.
+            The output is high on average duty / max_duty of the time, spreading high cycles over the period.
 
     Outputs:
         * signal: PWM signal
 
     """
 
-    def __init__(self, width: int):
+    def __init__(self, width: int, default_sigma_delta: bool = False):
 
         # In
         self.duty = Signal(width)
         self.max_duty = Signal(width)
+        self.sigma_delta = Signal(reset=int(default_sigma_delta))
 
         # Out
         self.signal = Signal(name="pwm_signal")
@@ -37,16 +40,37 @@ class PWMSignal(Elaboratable):
 
         counter = Signal.like(self.duty)
 
-        m.d.sync += counter.eq(counter + 1)
+        # Accumulated error, remains below max_duty
+        acc = Signal.like(self.duty)
+        total = Signal(self.duty.width + 1)
+        m.d.comb += total.eq(acc + self.duty)
 
-        with m.If(counter == self.max_duty):
-            m.d.sync += [
-                self.signal.eq(self.duty != 0),
-                counter.eq(0)
-            ]
+        with m.If(self.sigma_delta):
 
-        with m.Elif(counter == self.duty):
-            m.d.sync += self.signal.eq(0)
+            with m.If((total >= self.max_duty) & (self.duty != 0)):
+                m.d.sync += [
+                    self.signal.eq(1),
+                    acc.eq(total - self.max_duty)
+                ]
+
+            with m.Else():
+                m.d.sync += [
+                    self.signal.eq(0),
+                    acc.eq(total)
+                ]
+
+        with m.Else():
+
+            m.d.sync += counter.eq(counter + 1)
+
+            with m.If(counter == self.max_duty):
+                m.d.sync += [
+                    self.signal.eq(self.duty != 0),
+                    counter.eq(0)
+                ]
+
+            with m.Elif(counter == self.duty):
+                m.d.sync += self.signal.eq(0)
 
         return m
 
@@ -115,5 +139,67 @@ class PWMSignalTestSuite3(PWMSignalTestSuite):
     MAX_DUTY = 255
 
 
+class PWMSignalSigmaDeltaTestSuite(TestCase):
+
+    MAX_DUTY = 255
+
+    CYCLES = 3
+
+    def instantiate_dut(self):
+        return PWMSignal(width=util.bits_required(self.MAX_DUTY), default_sigma_delta=True)
+
+    def run_test(self, duty: int):
+
+        self.logger.info("duty: {} / {}".format(duty, self.MAX_DUTY))
+
+        yield self.dut.max_duty.eq(self.MAX_DUTY)
+        yield self.dut.duty.eq(duty)
+        yield
+
+        high = 0
+        longest = 0
+        run = 0
+        for i in range(self.CYCLES * self.MAX_DUTY):
+
+            yield
+            v = yield self.dut.signal
+
+            high += v
+            run = run + 1 if i and v == prev else 1
+            longest = max(longest, run)
+            prev = v
+
+        self.assertAlmostEqual(high, self.CYCLES * duty, delta=1)
+
+        # Same level is not held for longer than needed
+        if 0 < duty < self.MAX_DUTY:
+            d = min(duty, self.MAX_DUTY - duty)
+            self.assertLessEqual(longest, -(-self.MAX_DUTY // d))
+
+    @test_case
+    def test_zero(self):
+        yield from self.run_test(0)
+
+    @test_case
+    def test_one(self):
+        yield from self.run_test(1)
+
+    @test_case
+    def test_full(self):
+        yield from self.run_test(self.MAX_DUTY)
+
+    @test_case
+    def test_value_below_half(self):
+        yield from self.run_test(11)
+
+    @test_case
+    def test_value_half(self):
+        yield from self.run_test(self.MAX_DUTY // 2)
+
+    @test_case
+    def test_value_above_half(self):
+        yield from self.run_test(200)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,56 +2,216 @@ import logging
 import unittest
 
 from amaranth import *
-from amaranth.asserts import Fell, Rose
+from amaranth.lib.cdc import FFSynchronizer
+from amaranth.sim import Settle
 
 from hdl.test_common import TestCase, test_case
 
 
 class SPIInputChunked(Elaboratable):
 
-    def __init__(self, width: int, init: int = 0):
+    # Flip-flops resynchronizing CS, SCK and SDI to the clock
+    SYNC_STAGES = 2
+
+    # Clock cycles each SCK level must be held for its edges to be detected, SDI must be stable for as long
+    # around the SCK rising edge, and CS must stay high or low for as long between transactions
+    MIN_HALF_PERIOD = 2
+
+    # Addressed write: address byte followed by data byte
+    ADDRESS_WIDTH = 8
+    BYTE_WIDTH = 8
+
+    # Boot presets are selected by SCK (MSB) and SDI while reset is held, 0 keeping the initial data
+    PRESET_SELECT_WIDTH = 2
+
+    def __init__(
+            self, width: int, init: int = 0, sync_stages: int = SYNC_STAGES, readback_width: int = 0,
+            presets: [int] = ()):
+
+        assert width != self.ADDRESS_WIDTH + self.BYTE_WIDTH, "data width conflicts with addressed writes"
+        assert readback_width in (0, width) or readback_width > width, "readback conflicts with full writes"
+        assert len(presets) < 1 << self.PRESET_SELECT_WIDTH, "too many boot presets"
+
+        self.sync_stages = sync_stages
+        self.readback_width = readback_width
+        self.init = init
+        self.presets = presets
 
         # Inputs
         self.cs = Signal()
         self.sck = Signal()
         self.sdi = Signal()
+        # Latched when CS goes low and shifted out on SDO, most significant bit first
+        self.readback = Signal(readback_width)
 
         # Outputs
         self.busy = Signal()
+        # The full data word was received, or a boot preset was loaded on the first cycle after reset
         self.strobe = Signal()
         self.data = Signal(width, reset=init)
+        # An addressed write updated the data byte at address (byte 0 being the last one of a full word)
+        self.write_strobe = Signal()
+        # An addressed write beyond the data, to be interpreted as a command with the given address and value
+        self.command_strobe = Signal()
+        self.address = Signal(self.ADDRESS_WIDTH)
+        self.value = Signal(self.BYTE_WIDTH)
+        # Readback bit, updated after each SCK falling edge
+        self.sdo = Signal()
+        # A transaction ended with neither a full word nor an addressed write, longer ones and those with SDI held
+        # high being taken as reads with readback
+        self.error = Signal()
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info("SPI buffer width: {} bits".format(width))
 
+    @property
+    def bytes(self) -> int:
+        return (self.data.width + self.BYTE_WIDTH - 1) // self.BYTE_WIDTH
+
+    @staticmethod
+    def get_max_sck_freq(clock: float) -> float:
+        return clock / (2 * SPIInputChunked.MIN_HALF_PERIOD)
+
+    @staticmethod
+    def get_max_read_sck_freq(clock: float, sync_stages: int = SYNC_STAGES) -> float:
+
+        # SDO changes sync_stages + 1 cycles after CS or SCK fell, it must be stable at the next SCK rising edge
+        return clock / (2 * (sync_stages + 2))
+
     def elaborate(self, platform) -> Module:
 
         m = Module()
 
+        # The inputs are asynchronous to the clock, they all go through the same number of stages to remain aligned
+
+        if self.sync_stages:
+            cs, sck, sdi = Signal(reset=1), Signal(), Signal()
+            m.submodules.cs_sync = FFSynchronizer(self.cs, cs, reset=1, stages=self.sync_stages)
+            m.submodules.sck_sync = FFSynchronizer(self.sck, sck, stages=self.sync_stages)
+            m.submodules.sdi_sync = FFSynchronizer(self.sdi, sdi, stages=self.sync_stages)
+
+        else:
+            cs, sck, sdi = self.cs, self.sck, self.sdi
+
+        # Edges are detected against registered levels (rather than with Rose / Fell), so that a clock enable
+        # inserted around this module also applies to them
+
+        cs_prev, sck_prev = Signal.like(cs), Signal.like(sck)
+        m.d.sync += [
+            cs_prev.eq(cs),
+            sck_prev.eq(sck)
+        ]
+
+        cs_fell, cs_rose, sck_fell, sck_rose = Signal(), Signal(), Signal(), Signal()
+        m.d.comb += [
+            cs_fell.eq(cs_prev & ~cs),
+            cs_rose.eq(~cs_prev & cs),
+            sck_fell.eq(sck_prev & ~sck),
+            sck_rose.eq(~sck_prev & sck)
+        ]
+
+        # Bits are shifted in a separate register, data is only updated once the transaction completed
+
+        shift = Signal(self.data.width)
+
         # Count exact number of bit received to avoid strobe when it is not that expected,
-        # or remained 0 because CS just went low and up
-        i = Signal(range(self.data.width + 1))
+        # or remained 0 because CS just went low and up, saturates to reject longer transactions
+        i = Signal(range(self.data.width + 2))
+
+        addressed_width = self.ADDRESS_WIDTH + self.BYTE_WIDTH
+        address = shift[self.BYTE_WIDTH:addressed_width]
+        value = shift[0:self.BYTE_WIDTH]
+
+        m.d.sync += [
+            self.strobe.eq(0),
+            self.write_strobe.eq(0),
+            self.command_strobe.eq(0),
+            self.error.eq(0)
+        ]
+
+        # Readback shift register
+
+        rd = Signal(self.readback_width)
 
-        m.d.sync += self.strobe.eq(0)
+        # With readback, SDI held high at each SCK rising edge marks a read, which is never committed,
+        # so that an aborted read cannot be taken as a write
+        reading = Signal()
 
-        with m.If(Fell(self.cs)):
+        if self.readback_width:
+            m.d.comb += self.sdo.eq(rd[-1])
+
+        with m.If(cs_fell):
             m.d.sync += [
                 i.eq(0),
                 self.busy.eq(1)
             ]
 
-        with m.Elif(self.busy):
-
-            with m.If(Rose(self.cs)):
+            if self.readback_width:
                 m.d.sync += [
-                    self.strobe.eq(i == self.data.width),
-                    self.busy.eq(0),
+                    rd.eq(self.readback),
+                    reading.eq(1)
                 ]
 
-            with m.Elif(Rose(self.sck)):
+        with m.Elif(self.busy):
+
+            with m.If(cs_rose):
+                m.d.sync += self.busy.eq(0)
+
+                with m.If(reading):
+                    pass
+
+                with m.Elif(i == self.data.width):
+                    m.d.sync += [
+                        self.data.eq(shift),
+                        self.strobe.eq(1)
+                    ]
+
+                with m.Elif(i == addressed_width):
+                    m.d.sync += [
+                        self.address.eq(address),
+                        self.value.eq(value)
+                    ]
+
+                    with m.If(address < self.bytes):
+                        m.d.sync += [
+                            self.data.word_select(address, self.BYTE_WIDTH).eq(value),
+                            self.write_strobe.eq(1)
+                        ]
+
+                    with m.Else():
+                        m.d.sync += self.command_strobe.eq(1)
+
+                with m.Elif((i != 0) & ((i != self.data.width + 1) if self.readback_width else 1)):
+                    m.d.sync += self.error.eq(1)
+
+            with m.Elif(sck_rose):
+                m.d.sync += shift.eq(Cat(sdi, shift))
+
+                with m.If(~sdi):
+                    m.d.sync += reading.eq(0)
+
+                with m.If(i != self.data.width + 1):
+                    m.d.sync += i.eq(i + 1)
+
+            if self.readback_width:
+                # Ignore SCK falling before the first rising edge, when it was left high between transactions
+                with m.Elif(sck_fell & (i != 0)):
+                    m.d.sync += rd.eq(Cat(0, rd))
+
+        if self.presets:
+
+            # The pins are sampled for as long as reset is held, the selection is kept afterwards
+            preset = Signal(self.PRESET_SELECT_WIDTH, reset_less=True)
+            with m.If(ResetSignal()):
+                m.d.sync += preset.eq(Cat(sdi, sck))
+
+            booted = Signal()
+            m.d.sync += booted.eq(1)
+
+            with m.If(~booted & (preset != 0)):
                 m.d.sync += [
-                    self.data.eq(Cat(self.sdi, self.data[0:len(self.data)])),
-                    i.eq(i + 1)
+                    self.data.eq(Array(Const(v, self.data.width) for v in (self.init,) + tuple(self.presets))[preset]),
+                    self.strobe.eq(1)
                 ]
 
         return m
@@ -62,7 +222,7 @@ class SPIInputChunked(Elaboratable):
 
 class SPIInputTestSuite(TestCase):
 
-    WIDTH = 16
+    WIDTH = 24
 
     DELAY = 4
 
@@ -90,14 +250,14 @@ class SPIInputTestSuite(TestCase):
     def instantiate_dut(self):
         return SPIInputChunked(self.WIDTH)
 
-    def send(self, val: int):
+    def transfer(self, val: int, width: int):
 
         # TODO: do it in another clock domain instead and avoid clock aligned transitions
 
         yield from self.do_cs_low()
 
         v = val
-        for i in reversed(range(self.WIDTH)):
+        for i in reversed(range(width)):
             yield self.dut.sdi.eq((v >> i) & 1)
             yield from self.do_clock_tick()
 
@@ -107,7 +267,14 @@ class SPIInputTestSuite(TestCase):
         yield self.dut.cs.eq(1)
         yield
 
-        yield
+        # Strobes come after the synchronizer stages
+        for _ in range(self.dut.sync_stages + 1):
+            yield
+
+    def send(self, val: int):
+
+        yield from self.transfer(val, self.WIDTH)
+
         strobe = yield self.dut.strobe
         self.assertTrue(strobe, "strobe is not asserted")
 
@@ -120,7 +287,194 @@ class SPIInputTestSuite(TestCase):
 
     @test_case
     def test(self):
-        yield from self.send(0x89C5)
+        yield from self.send(0x89C5A3)
+
+
+class SPIInputFastTestSuite(SPIInputTestSuite):
+
+    # SCK at its maximum frequency
+    DELAY = SPIInputChunked.MIN_HALF_PERIOD
+
+    @test_case
+    def test(self):
+        yield from self.send(0x89C5A3)
+        yield from self.send(0x5A3C96)
+
+
+class SPIInputUnsynchronizedTestSuite(SPIInputTestSuite):
+
+    def instantiate_dut(self):
+        return SPIInputChunked(self.WIDTH, sync_stages=0)
+
+
+class SPIInputAddressedTestSuite(SPIInputTestSuite):
+
+    def write(self, address: int, value: int):
+
+        yield from self.transfer((address << 8) | value, 16)
+
+        strobes = []
+        for s in [self.dut.strobe, self.dut.write_strobe, self.dut.command_strobe]:
+            v = yield s
+            strobes.append(v)
+
+        return strobes
+
+    @test_case
+    def test(self):
+
+        yield from self.send(0x89C5A3)
+
+        # Update middle byte only
+        strobes = yield from self.write(1, 0x17)
+        self.assertEqual(strobes, [0, 1, 0])
+
+        data = yield self.dut.data
+        self.assertEqual(data, 0x8917A3)
+
+        # Command, data is unchanged
+        strobes = yield from self.write(0xF0, 0x42)
+        self.assertEqual(strobes, [0, 0, 1])
+
+        address = yield self.dut.address
+        value = yield self.dut.value
+        data = yield self.dut.data
+        self.assertEqual((address, value, data), (0xF0, 0x42, 0x8917A3))
+
+    @test_case
+    def test_invalid_length(self):
+
+        yield from self.send(0x89C5A3)
+
+        # Neither a full word nor an addressed write, including a count going past the counter range
+        for width in [15, 17, self.WIDTH + 1, self.WIDTH + 32]:
+            yield from self.transfer(0x5A3C96, width)
+
+            strobes = []
+            for s in [self.dut.strobe, self.dut.write_strobe, self.dut.command_strobe, self.dut.error]:
+                v = yield s
+                strobes.append(v)
+            self.assertEqual(strobes, [0, 0, 0, 1], "width {}".format(width))
+
+            data = yield self.dut.data
+            self.assertEqual(data, 0x89C5A3)
+
+
+class SPIInputPresetsTestSuite(SPIInputTestSuite):
+
+    PRESETS = (0x123456, 0x89C5A3, 0x5A3C96)
+
+    def instantiate_dut(self):
+        return SPIInputChunked(self.WIDTH, init=0xFFFFFF, presets=self.PRESETS)
+
+    def do_boot(self, select: int):
+
+        yield self.dut.cs.eq(1)
+        yield self.dut.sck.eq(select >> 1)
+        yield self.dut.sdi.eq(select & 1)
+
+        yield self.cd_sync.rst.eq(1)
+        for _ in range(self.dut.sync_stages + 2):
+            yield
+        yield self.cd_sync.rst.eq(0)
+        yield self.dut.sck.eq(0)
+        yield self.dut.sdi.eq(0)
+
+        # Preset is loaded on the first cycle after reset
+        yield
+        yield Settle()
+
+        strobe = yield self.dut.strobe
+        data = yield self.dut.data
+
+        return strobe, data
+
+    @test_case
+    def test(self):
+
+        for select in [1, 2, 3, 0]:
+            strobe, data = yield from self.do_boot(select)
+            self.assertEqual(strobe, int(select != 0), "preset {}".format(select))
+            self.assertEqual(data, ((0xFFFFFF,) + self.PRESETS)[select], "preset {}".format(select))
+
+        # Preset can be overwritten over SPI
+        yield from self.do_boot(2)
+        yield from self.send(0x2468AC)
+
+
+class SPIInputReadbackTestSuite(SPIInputTestSuite):
+
+    READBACK_WIDTH = 40
+
+    READBACK = 0xA5C3E1F00F
+
+    DELAY = SPIInputChunked.SYNC_STAGES + 2
+
+    def instantiate_dut(self):
+        return SPIInputChunked(self.WIDTH, readback_width=self.READBACK_WIDTH)
+
+    def read(self, width: int = READBACK_WIDTH):
+
+        yield self.dut.readback.eq(self.READBACK)
+        yield self.dut.sdi.eq(1)
+
+        yield from self.do_cs_low()
+        yield from self.do_wait()
+
+        # Sample on SCK rising edges, SDI held high
+        res = 0
+        for _ in range(width):
+            yield self.dut.sck.eq(0)
+            yield from self.do_wait()
+            v = yield self.dut.sdo
+            res = (res << 1) | v
+            yield self.dut.sck.eq(1)
+            yield from self.do_wait()
+
+        yield self.dut.sck.eq(0)
+        yield
+        yield self.dut.cs.eq(1)
+        yield
+
+        return res
+
+    @test_case
+    def test(self):
+
+        yield from self.send(0x89C5A3)
+
+        v = yield from self.read()
+        self.assertEqual(v, self.READBACK)
+
+        # Reading does not change the data
+        for _ in range(self.dut.sync_stages + 2):
+            yield
+        data = yield self.dut.data
+        self.assertEqual(data, 0x89C5A3)
+
+    @test_case
+    def test_aborted(self):
+
+        yield from self.send(0x89C5A3)
+
+        # Reads stopped at the length of a write are neither committed nor errors
+        for width in [16, self.WIDTH, 7]:
+            v = yield from self.read(width)
+            self.assertEqual(v, self.READBACK >> (self.READBACK_WIDTH - width))
+
+            strobes = []
+            for _ in range(self.dut.sync_stages + 2):
+                for s in [self.dut.strobe, self.dut.write_strobe, self.dut.command_strobe, self.dut.error]:
+                    v = yield s
+                    strobes.append(v)
+                yield
+            self.assertEqual(sum(strobes), 0, "width {}".format(width))
+
+            data = yield self.dut.data
+            self.assertEqual(data, 0x89C5A3)
+
+        # Writes are still committed
+        yield from self.send(0x5A3C96)
 
 
 if __name__ == "__main__":
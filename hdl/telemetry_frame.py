@@ -0,0 +1,145 @@
+import logging
+import unittest
+
+from amaranth import *
+
+import hdl.util as util
+
+from hdl.test_common import TestCase, test_case
+
+
+class TelemetryFrame(Elaboratable):
+
+    """
+    Telemetry frame sent on the serial output instead of the bare counter value.
+
+    Bytes, in the order they are sent:
+        * sync byte (0xA5)
+        * value, least significant byte first
+        * status: direction (bit 0), gear (bits 3:1), flags (bits 7:4)
+        * sequence number, incremented with each update so that a gap reveals an update not sent
+        * CRC-8 (polynomial 0x07, initial value 0) of all previous bytes including sync
+
+    Inputs:
+        * value: counter value (with revolutions if any)
+        * direction, gear, flags: current status
+        * strobe: value is updated on next cycle
+
+    Outputs:
+        * frame: frame to send, first byte in the least significant bits
+
+    """
+
+    SYNC = 0xA5
+
+    GEAR_WIDTH = 3
+    FLAGS_WIDTH = 4
+
+    CRC_POLY = 0x07
+
+    def __init__(self, width: int):
+
+        self.value_bytes = -(-width // 8)
+
+        # Inputs
+        self.value = Signal(width)
+        self.direction = Signal()
+        self.gear = Signal(self.GEAR_WIDTH)
+        self.flags = Signal(self.FLAGS_WIDTH)
+        self.strobe = Signal()
+
+        # Outputs
+        self.frame = Signal((self.value_bytes + 4) * 8)
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.info("frame length: {} bytes".format(len(self.frame) // 8))
+
+    @staticmethod
+    def crc8(m: Module, data: Value, poly: int = CRC_POLY) -> Value:
+
+        # Bytes are processed from the least significant, each from its MSB as with util.crc8,
+        # intermediate values are kept in signals to avoid duplicating logic
+
+        crc = Const(0, 8)
+
+        for i in range(len(data) // 8):
+            for b in reversed(range(8)):
+                fb = crc[7] ^ data[i * 8 + b]
+                nxt = Signal(8, name="crc_{}_{}".format(i, b))
+                m.d.comb += nxt.eq(Cat(fb, crc[0:7]) ^ Mux(fb, poly & 0xFE, 0))
+                crc = nxt
+
+        return crc
+
+    def elaborate(self, platform) -> Module:
+
+        m = Module()
+
+        seq = Signal(8)
+
+        with m.If(self.strobe):
+            m.d.sync += seq.eq(seq + 1)
+
+        payload = Cat(
+            Const(self.SYNC, 8),
+            self.value,
+            Const(0, self.value_bytes * 8 - len(self.value)),
+            self.direction,
+            self.gear,
+            self.flags,
+            seq)
+
+        m.d.comb += self.frame.eq(Cat(payload, self.crc8(m, payload)))
+
+        return m
+
+
+#######################################################################################################################
+
+
+class TelemetryFrameTestSuite(TestCase):
+
+    WIDTH = 16
+
+    def instantiate_dut(self):
+        return TelemetryFrame(width=self.WIDTH)
+
+    def check_frame(self, value: int, direction: int, gear: int, flags: int, seq: int):
+
+        frame = yield self.dut.frame
+        data = frame.to_bytes(len(self.dut.frame) // 8, "little")
+
+        self.assertEqual(data[0], TelemetryFrame.SYNC)
+        self.assertEqual(int.from_bytes(data[1:-3], "little"), value)
+        self.assertEqual(data[-3], direction | (gear << 1) | (flags << 4))
+        self.assertEqual(data[-2], seq)
+        self.assertEqual(data[-1], util.crc8(data[:-1]))
+
+    @test_case
+    def test(self):
+
+        for seq, (value, direction, gear, flags) in enumerate([
+                (0x1234, 1, 2, 0b1010),
+                (0xFFFF, 0, 0, 0),
+                (0x0001, 1, 7, 0b1111)]):
+
+            yield self.dut.value.eq(value)
+            yield self.dut.direction.eq(direction)
+            yield self.dut.gear.eq(gear)
+            yield self.dut.flags.eq(flags)
+            yield self.dut.strobe.eq(1)
+            yield
+            yield self.dut.strobe.eq(0)
+            yield
+
+            yield from self.check_frame(value & util.max_for_bits(self.WIDTH), direction, gear, flags, seq + 1)
+
+
+class TelemetryFrameTestSuite2(TelemetryFrameTestSuite):
+
+    WIDTH = 8
+
+
+if __name__ == "__main__":
+    logging.root.setLevel(logging.DEBUG)
+    unittest.main()
@@ -8,7 +8,8 @@ import unittest
 
 from functools import wraps
 
-from amaranth.sim import Simulator
+from amaranth import *
+from amaranth.sim import Passive, Simulator
 
 import hdl.config as config
 
@@ -32,17 +33,49 @@ def test_case(process_function):
     return run_test
 
 
+def add_fast_channels(sim: Simulator, channels: Signal, ratio: float, hold_cycles: int, domain: str = "fast") -> [int]:
+
+    # Clock ratio times faster than sync for the domain, in which the channels take the values appended to the
+    # returned list, each held for hold_cycles cycles of that domain
+
+    sequence = []
+
+    def process():
+
+        yield Passive()
+
+        while True:
+            if sequence:
+                yield channels.eq(sequence.pop(0))
+            for _ in range(hold_cycles):
+                yield
+
+    sim.add_clock(1 / (config.CLOCK_FREQ * ratio), domain=domain)
+    sim.add_sync_process(process, domain=domain)
+
+    return sequence
+
+
 class TestCase(unittest.TestCase):
 
     def instantiate_dut(self):
         pass
 
+    def wrap_dut(self, dut):
+        # Simulated in place of the dut, e.g. with control inserted
+        return dut
+
     def setUp(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self.dut = self.instantiate_dut()
 
-        self.sim = Simulator(self.dut)
+        # Explicit sync domain, so that tests can drive its reset
+        m = Module()
+        m.domains.sync = self.cd_sync = ClockDomain("sync")
+        m.submodules.dut = self.wrap_dut(self.dut)
+
+        self.sim = Simulator(m)
         self.sim.add_clock(1 / config.CLOCK_FREQ)
 
 
@@ -2,7 +2,10 @@ import logging
 import unittest
 
 from amaranth import *
+from amaranth.lib.fifo import SyncFIFO
+from amaranth.sim import Settle
 
+import hdl.config as config
 import hdl.util as util
 
 from hdl.test_common import TestCase, test_case
@@ -10,65 +13,193 @@ from hdl.test_common import TestCase, test_case
 
 class UARTOutput(Elaboratable):
 
+    """
+    UART transmitter (N-1, no parity) shifting out one bit per clock cycle,
+    or at a fractional rate of the clock with a baud increment (see get_baud_increment).
+
+    Words wider than word_len are sent as consecutive frames, least significant word first;
+    the idle cycles are only inserted after the last frame.
+
+    Without FIFO only the latest word is sent, strobes while a word is already pending are dropped.
+    With a FIFO, the word is queued on the cycle following the strobe (when the counter value is updated)
+    and it is only dropped if the FIFO is full.
+    Dropped words are signalled by the dropped strobe, the overflow flag and the dropped count until cleared.
+
+    With immediate, the word is expected to be valid along with the strobe: it is loaded in the same cycle
+    if the transmitter is ready (or queued on the same cycle with a FIFO).
+    """
+
     DEFAULT_WORD_LEN = 8
     DEFAULT_IDLE_CYCLES = 4
 
-    def __init__(self, width: int, word_len: int = DEFAULT_WORD_LEN, idle_cycles: int = DEFAULT_IDLE_CYCLES):
+    DROPPED_COUNT_WIDTH = 8
+
+    # A bit is shifted out each time the accumulator incremented every cycle overflows
+    BAUD_ACC_WIDTH = 16
+
+    # Largest relative error of the generated baud rate, within what receivers tolerate
+    BAUD_TOLERANCE = 0.02
+
+    def __init__(
+            self,
+            width: int,
+            word_len: int = DEFAULT_WORD_LEN,
+            idle_cycles: int = DEFAULT_IDLE_CYCLES,
+            fifo_depth: int = 0,
+            default_baud_increment: int = None,
+            immediate: bool = False):
+
+        assert default_baud_increment is None or 0 < default_baud_increment <= util.max_for_bits(self.BAUD_ACC_WIDTH), \
+            "invalid baud increment"
 
         self.word_len = word_len
         self.idle_cycles = idle_cycles
+        self.frames = -(-width // word_len)
+        self.fifo_depth = fifo_depth
+        self.fractional = default_baud_increment is not None
+        self.immediate = immediate
 
         # Inputs
         self.word = Signal(width)
         self.strobe = Signal()
+        self.clear = Signal()
+        self.baud_increment = Signal(self.BAUD_ACC_WIDTH, reset=default_baud_increment or 0)
 
         # Outputs
         self.tx = Signal()
+        self.dropped = Signal()
+        self.overflow = Signal()
+        self.dropped_count = Signal(self.DROPPED_COUNT_WIDTH)
 
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.logger.info("{}-N-1, {} idle cycles".format(self.word_len, self.idle_cycles))
+        self.logger.info("{}-N-1, {} frame(s), {} idle cycles, FIFO depth {}, baud increment {}".format(
+            self.word_len, self.frames, self.idle_cycles, self.fifo_depth, default_baud_increment))
+
+    @staticmethod
+    def get_baud_increment(baudrate: float, clock: float) -> int:
+
+        inc = int(round(baudrate / clock * (1 << UARTOutput.BAUD_ACC_WIDTH)))
+        assert 0 < inc <= util.max_for_bits(UARTOutput.BAUD_ACC_WIDTH), \
+            "baud rate {} cannot be generated from clock {}".format(baudrate, clock)
+        assert abs(UARTOutput.get_baudrate(inc, clock) / baudrate - 1) <= UARTOutput.BAUD_TOLERANCE, \
+            "baud rate {} cannot be generated accurately from clock {}".format(baudrate, clock)
+
+        return inc
+
+    @staticmethod
+    def get_baudrate(baud_increment: int, clock: float) -> float:
+        return clock * baud_increment / (1 << UARTOutput.BAUD_ACC_WIDTH)
 
     def elaborate(self, platform) -> Module:
 
         m = Module()
 
-        i = Signal(4)
+        # Next word to send is available
         start = Signal()
+        next_word = Signal.like(self.word)
 
-        # Data to shift out: start (1 bit), word, stop (1 bit), idle time
+        # Data to shift out: for each frame start (1 bit), word, stop (1 bit); then idle time
         # Reset to 1 for idle state / stop bit
-        data = Signal(self.word_len + 2 + self.idle_cycles, reset=1)
+        data = Signal(self.frames * (self.word_len + 2) + self.idle_cycles, reset=1)
+
+        i = Signal(range(data.width))
+
+        # Word padded to a whole number of frames
+        word = Cat(next_word, Const(0, unsigned(self.frames * self.word_len - self.word.width)))
 
         m.d.comb += self.tx.eq(data[0])
 
+        # Time to shift the next bit out
+        tick = Signal()
+
+        if self.fractional:
+            acc = Signal(self.BAUD_ACC_WIDTH)
+            acc_next = Signal(self.BAUD_ACC_WIDTH + 1)
+            m.d.comb += [
+                acc_next.eq(acc + self.baud_increment),
+                tick.eq(acc_next[-1])
+            ]
+            m.d.sync += acc.eq(acc_next[:-1])
+
+        else:
+            m.d.comb += tick.eq(1)
+
+        # Ready to load the next word after the last bit
+        ready = Signal()
+        m.d.comb += ready.eq((i == 0) & tick)
+
         # Continue transmitting once started,
         # we only check for the next start condition upon completion
-        with m.If(i != 0):
+        with m.If((i != 0) & tick):
             m.d.sync += [
                 data.eq(data.shift_right(1)),
                 i.eq(i - 1)
             ]
 
-        with m.Elif(start):
+        with m.Elif(ready & start):
             m.d.sync += [
-                start.eq(0),
                 i.eq(data.width - 1),
 
-                # Idle bits (high), stop bit (high), fill, word, start bit (low)
+                # Idle bits (high), then per frame (from the last): stop bit (high), fill, word, start bit (low)
                 # Output is LSB of data
                 data.eq(Cat(
-                    Const(0),
-                    self.word,
-                    Const(0, unsigned(self.word_len - self.word.width)),
-                    Const(util.max_for_bits(1 + self.idle_cycles))))
+                    *(Cat(Const(0), word.word_select(f, self.word_len), Const(1)) for f in range(self.frames)),
+                    Const(util.max_for_bits(self.idle_cycles), unsigned(self.idle_cycles))))
             ]
 
-        # Start is normally de-asserted above,
-        # but it can be overridden within the same cycle if there is another word to transmit
-        # Note that the word that will serve to init data is not necessarily the same as that for
-        # which the strobe was first asserted; it does not matter, the strobe only notifies of something to send
-        with m.If(self.strobe):
-            m.d.sync += start.eq(1)
+        if self.fifo_depth:
+
+            fifo = SyncFIFO(width=self.word.width, depth=self.fifo_depth)
+            m.submodules.fifo = fifo
+
+            push = Signal()
+            if self.immediate:
+                m.d.comb += push.eq(self.strobe)
+            else:
+                m.d.sync += push.eq(self.strobe)
+
+            m.d.comb += [
+                fifo.w_data.eq(self.word),
+                fifo.w_en.eq(push),
+                self.dropped.eq(push & ~fifo.w_rdy),
+
+                start.eq(fifo.r_rdy),
+                next_word.eq(fifo.r_data),
+                fifo.r_en.eq(ready)
+            ]
+
+        else:
+
+            pending = Signal()
+
+            m.d.comb += [
+                start.eq(pending | self.strobe) if self.immediate else start.eq(pending),
+                next_word.eq(self.word),
+                self.dropped.eq(self.strobe & pending & ~ready)
+            ]
+
+            # Pending is normally de-asserted once transmitting,
+            # but it can be overridden within the same cycle if there is another word to transmit
+            # Note that the word that will serve to init data is not necessarily the same as that for
+            # which the strobe was first asserted; it does not matter, the strobe only notifies of something to send
+            with m.If(ready):
+                m.d.sync += pending.eq(0)
+
+            # An immediate word is sent right away when ready
+            with m.If(self.strobe & ~ready if self.immediate else self.strobe):
+                m.d.sync += pending.eq(1)
+
+        with m.If(self.clear):
+            m.d.sync += [
+                self.overflow.eq(0),
+                self.dropped_count.eq(0)
+            ]
+
+        with m.Elif(self.dropped):
+            m.d.sync += self.overflow.eq(1)
+
+            with m.If(~self.dropped_count.all()):
+                m.d.sync += self.dropped_count.eq(self.dropped_count + 1)
 
         return m
 
@@ -139,5 +270,233 @@ class UARTOutputTestSuite3(UARTOutputTestSuite):
     WORD_LEN = 8
 
 
+class UARTOutputMultiFrameTestSuite(TestCase):
+
+    COUNTER_WIDTH = 16
+    WORD_LEN = 8
+
+    def instantiate_dut(self):
+        return UARTOutput(width=self.COUNTER_WIDTH, word_len=self.WORD_LEN)
+
+    @test_case
+    def test(self):
+
+        word = 0xA5C3
+
+        yield self.dut.word.eq(word)
+        yield self.dut.strobe.eq(1)
+        yield
+        yield self.dut.strobe.eq(0)
+        yield
+
+        frame_len = self.WORD_LEN + 2
+        frames = self.COUNTER_WIDTH // self.WORD_LEN
+
+        result = 0
+        for i in range(frames * frame_len + UARTOutput.DEFAULT_IDLE_CYCLES + 1):
+            v = yield self.dut.tx
+            result |= v << i
+            yield
+
+        # Extra cycle after strobe
+        self.assertEqual(result & 1, 1)
+        result >>= 1
+
+        # Little-endian frames, each with start and stop bit
+        for f in range(frames):
+            frame = (result >> (f * frame_len)) & util.max_for_bits(frame_len)
+            self.assertEqual(frame & 1, 0, "missing start bit")
+            self.assertEqual(frame >> (frame_len - 1), 1, "missing stop bit")
+            self.assertEqual((frame >> 1) & util.max_for_bits(self.WORD_LEN), (word >> (f * self.WORD_LEN)) & 0xFF)
+
+        self.assertEqual(result >> (frames * frame_len), util.max_for_bits(UARTOutput.DEFAULT_IDLE_CYCLES))
+
+
+class UARTOutputBaudRateTestSuite(TestCase):
+
+    COUNTER_WIDTH = 16
+    WORD_LEN = 8
+
+    # Cycles per bit
+    DIVIDER = 3.3
+
+    def instantiate_dut(self):
+        return UARTOutput(
+            width=self.COUNTER_WIDTH, word_len=self.WORD_LEN,
+            default_baud_increment=UARTOutput.get_baud_increment(config.CLOCK_FREQ / self.DIVIDER, config.CLOCK_FREQ))
+
+    @test_case
+    def test(self):
+
+        word = 0x5AC3
+
+        yield self.dut.word.eq(word)
+        yield self.dut.strobe.eq(1)
+        yield
+        yield self.dut.strobe.eq(0)
+
+        frames = self.COUNTER_WIDTH // self.WORD_LEN
+        bits = frames * (self.WORD_LEN + 2)
+
+        tx = []
+        for _ in range(int((bits + UARTOutput.DEFAULT_IDLE_CYCLES + 2) * self.DIVIDER)):
+            yield
+            v = yield self.dut.tx
+            tx.append(v)
+
+        # Sample in the middle of each bit from the start bit falling edge
+        start = tx.index(0)
+        result = 0
+        for b in range(bits):
+            result |= tx[start + int((b + 0.5) * self.DIVIDER)] << b
+
+        for f in range(frames):
+            frame = (result >> (f * (self.WORD_LEN + 2))) & util.max_for_bits(self.WORD_LEN + 2)
+            self.assertEqual(frame & 1, 0, "missing start bit")
+            self.assertEqual(frame >> (self.WORD_LEN + 1), 1, "missing stop bit")
+            self.assertEqual((frame >> 1) & util.max_for_bits(self.WORD_LEN), (word >> (f * self.WORD_LEN)) & 0xFF)
+
+        # Frame lasts the expected time
+        end = len(tx) - tx[::-1].index(0)
+        self.assertAlmostEqual(end - start, (bits - 1) * self.DIVIDER, delta=self.DIVIDER)
+
+    def test_baud_error(self):
+
+        # Increment of 6.3 rounded to 6, the rate would be 4.6 % off
+        with self.assertRaises(AssertionError):
+            UARTOutput.get_baud_increment(9600, 100e6)
+
+
+class UARTOutputFIFOTestSuite(TestCase):
+
+    COUNTER_WIDTH = 8
+    WORD_LEN = 8
+
+    FIFO_DEPTH = 4
+
+    IMMEDIATE = False
+
+    # Cycles from the strobe to the start bit
+    LATENCY = 3
+
+    def instantiate_dut(self):
+        return UARTOutput(
+            width=self.COUNTER_WIDTH, word_len=self.WORD_LEN, fifo_depth=self.FIFO_DEPTH, immediate=self.IMMEDIATE)
+
+    def do_tick(self, tx: [int]):
+        v = yield self.dut.tx
+        tx.append(v)
+        yield
+
+    def decode(self, tx: [int]) -> [int]:
+
+        words = []
+
+        bits = None
+        for v in tx:
+            if bits is None:
+                if not v:
+                    bits = []
+            elif len(bits) < self.WORD_LEN:
+                bits.append(v)
+            else:
+                self.assertEqual(v, 1, "missing stop bit")
+                words.append(sum(b << i for i, b in enumerate(bits)))
+                bits = None
+
+        return words
+
+    def run_test(self, words: [int], expected: [int]):
+
+        tx = []
+
+        # Word is updated on the cycle following the strobe, as with the counter, unless immediate
+        for w in words:
+            yield self.dut.strobe.eq(1)
+            if self.IMMEDIATE:
+                yield self.dut.word.eq(w)
+            yield from self.do_tick(tx)
+            yield self.dut.strobe.eq(0)
+            yield self.dut.word.eq(w)
+            yield from self.do_tick(tx)
+
+        for _ in range((len(words) + 1) * (self.WORD_LEN + 2 + UARTOutput.DEFAULT_IDLE_CYCLES)):
+            yield from self.do_tick(tx)
+
+        self.assertEqual(self.decode(tx), expected)
+
+        v = yield self.dut.overflow
+        self.assertEqual(v, int(len(words) != len(expected)))
+        v = yield self.dut.dropped_count
+        self.assertEqual(v, len(words) - len(expected))
+
+        yield self.dut.clear.eq(1)
+        yield
+        yield self.dut.clear.eq(0)
+        yield
+
+        v = yield self.dut.overflow
+        self.assertFalse(v)
+
+    @test_case
+    def test(self):
+        words = [0x12, 0x34, 0x56, 0x78, 0x9A]
+        yield from self.run_test(words, words)
+
+    @test_case
+    def test_overflow(self):
+        # One word is shifted out while the FIFO fills up
+        words = list(range(1, self.FIFO_DEPTH + 4))
+        yield from self.run_test(words, words[:self.FIFO_DEPTH + 1])
+
+    @test_case
+    def test_latency(self):
+
+        yield self.dut.strobe.eq(1)
+        yield self.dut.word.eq(0x12)
+        yield
+        yield self.dut.strobe.eq(0)
+
+        for c in range(1, 8):
+            yield Settle()
+            v = yield self.dut.tx
+            if not v:
+                break
+            yield
+
+        self.assertEqual(c, self.LATENCY)
+
+
+class UARTOutputImmediateFIFOTestSuite(UARTOutputFIFOTestSuite):
+
+    IMMEDIATE = True
+
+    LATENCY = 2
+
+
+class UARTOutputLatestTestSuite(UARTOutputFIFOTestSuite):
+
+    FIFO_DEPTH = 0
+
+    LATENCY = 2
+
+    @test_case
+    def test(self):
+        yield from self.run_test([0x12], [0x12])
+
+    @test_case
+    def test_overflow(self):
+        # First word is sent right away, then the pending word is replaced by the next ones
+        words = [0x12, 0x34, 0x56, 0x78, 0x9A]
+        yield from self.run_test(words, [0x12, 0x9A])
+
+
+class UARTOutputImmediateLatestTestSuite(UARTOutputLatestTestSuite):
+
+    IMMEDIATE = True
+
+    LATENCY = 1
+
+
 if __name__ == "__main__":
     unittest.main()
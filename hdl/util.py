@@ -17,3 +17,16 @@ def bits_required(v: int):
 
 def is_power2(v: int):
     return v != 0 and v & (v - 1) == 0
+
+
+def crc8(data: bytes, poly: int = 0x07, init: int = 0x00):
+
+    # CRC-8 (MSB first, no reflection, no final XOR), reference for the hardware implementation
+
+    crc = init
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xFF
+
+    return crc
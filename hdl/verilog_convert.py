@@ -47,12 +47,7 @@ class Top(Elaboratable):
 
         # Outputs
 
-        outputs = Cat(
-            dev.serial_tx,
-            dev.pwm,
-            dev.direction,
-            dev.counter[0:config.OUTPUT_WIDTH]
-        )
+        outputs = dev.outputs
 
         assert outputs.shape() == self.io_out.shape(), "inconsistent output shape"
 
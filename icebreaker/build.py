@@ -7,6 +7,8 @@ from amaranth_boards.icebreaker import ICEBreakerPlatform
 
 from icebreaker.icebreaker_device import ICEBreakerDevice
 
+import hdl.config as config
+
 BUILD_NAME = "top"
 BUILD_DIR = "build"
 
@@ -17,11 +19,26 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--program", action="store_true", required=False,
                         help="program the ICEBreaker after building the device")
+    parser.add_argument("-c", "--clock", type=float, default=config.CLOCK_FREQ, required=False,
+                        help="device clock frequency (Hz), from the low frequency oscillator up to 10 kHz, "
+                             "from the 12 MHz board clock with a clock enable up to 12 MHz, otherwise from the PLL")
+    parser.add_argument("-f", "--fast-decoder", action="store_true", required=False,
+                        help="run the decoder from the oscillator (or the global clock with a clock enable), "
+                             "when the device clock is divided")
+    parser.add_argument("-s", "--source", choices=[
+                            ICEBreakerDevice.CLOCK_LFOSC, ICEBreakerDevice.CLOCK_BOARD,
+                            ICEBreakerDevice.CLOCK_HFOSC, ICEBreakerDevice.CLOCK_PLL], required=False,
+                        help="clock source, the device runs with a clock enable from the board, HFOSC or PLL "
+                             "global clock (default: derived from the device clock frequency)")
+    parser.add_argument("--source-freq", type=float, default=None, required=False,
+                        help="HFOSC (48 MHz divided by 1, 2, 4 or 8) or PLL frequency (Hz), 12 MHz by default")
 
     args = parser.parse_args()
 
     p = ICEBreakerPlatform()
-    p.build(ICEBreakerDevice(),
+    p.build(ICEBreakerDevice(
+                clock_freq=args.clock, fast_decoder=args.fast_decoder,
+                clock_source=args.source, source_freq=args.source_freq),
             name=BUILD_NAME,
             build_dir=BUILD_DIR,
             do_program=args.program,
@@ -34,10 +51,10 @@ if __name__ == "__main__":
         "ICESTORM_RAM",
         "SB_IO",
         "SB_GB",
-        # "ICESTORM_PLL",
+        "ICESTORM_PLL",
         # "SB_WARMBOOT",
         # "ICESTORM_DSP",
-        # "ICESTORM_HFOSC",
+        "ICESTORM_HFOSC",
         "ICESTORM_LFOSC",
         # "SB_I2C",
         # "SB_SPI",
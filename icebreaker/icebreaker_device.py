@@ -43,10 +43,81 @@ IC_PMOD = [
 
 
 class ICEBreakerDevice(Elaboratable):
-    def __init__(self):
+
+    LFOSC_FREQ = 10e3
+    BOARD_FREQ = 12e6
+    HFOSC_FREQ = 48e6
+
+    # Default HFOSC / PLL global clock, the highest one the HFOSC can give that meets timing, with or without the
+    # fast decoder (see reports/icebreaker_builds.txt)
+    SOURCE_FREQ = 12e6
+
+    # Clock sources: low frequency oscillator (divided), board clock, high frequency oscillator or PLL,
+    # the latter three running the device with a clock enable
+    CLOCK_LFOSC = "lfosc"
+    CLOCK_BOARD = "board"
+    CLOCK_HFOSC = "hfosc"
+    CLOCK_PLL = "pll"
+
+    def __init__(
+            self,
+            clock_freq: float = config.CLOCK_FREQ,
+            fast_decoder: bool = False,
+            clock_source: str = None,
+            source_freq: float = None):
 
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        if clock_source is None:
+            if clock_freq <= self.LFOSC_FREQ:
+                clock_source = self.CLOCK_LFOSC
+            elif clock_freq <= self.BOARD_FREQ:
+                clock_source = self.CLOCK_BOARD
+            else:
+                clock_source = self.CLOCK_PLL
+                if source_freq is None:
+                    source_freq = clock_freq
+
+        if clock_source in (self.CLOCK_HFOSC, self.CLOCK_PLL) and source_freq is None:
+            source_freq = self.SOURCE_FREQ
+
+        assert clock_source in (self.CLOCK_LFOSC, self.CLOCK_BOARD, self.CLOCK_HFOSC, self.CLOCK_PLL), \
+            f"unsupported clock source {clock_source}"
+
+        self.clock_freq = clock_freq
+        self.clock_source = clock_source
+        # Global clock frequency with HFOSC (48 MHz divided by 1, 2, 4 or 8) or PLL
+        self.source_freq = source_freq
+        # Decoder runs from the oscillator instead of the divided clock, or from the global clock with a clock enable
+        self.fast_decoder = fast_decoder
+
+    @staticmethod
+    def get_pll_params(f_in: float, f_out: float) -> (int, int, int, int, float):
+
+        # SB_PLL40 simple feedback: f_out = f_in * (DIVF + 1) / ((DIVR + 1) * 2^DIVQ),
+        # with the phase detector between 10 and 133 MHz and the VCO between 533 and 1066 MHz
+
+        best = None
+        for divr in range(16):
+            f_pfd = f_in / (divr + 1)
+            if not 10e6 <= f_pfd <= 133e6:
+                continue
+
+            for divf in range(128):
+                f_vco = f_pfd * (divf + 1)
+                if not 533e6 <= f_vco <= 1066e6:
+                    continue
+
+                for divq in range(1, 7):
+                    f = f_vco / (1 << divq)
+                    if best is None or abs(f - f_out) < abs(best[-1] - f_out):
+                        filter_range = 1 + sum(f_pfd >= t for t in (17e6, 26e6, 44e6, 66e6, 101e6))
+                        best = (divr, divf, divq, filter_range, f)
+
+        assert best is not None, f"no PLL configuration for {f_out} Hz"
+
+        return best
+
     def elaborate(self, platform) -> Module:
 
         platform.add_resources(IC_PMOD)
@@ -56,50 +127,147 @@ class ICEBreakerDevice(Elaboratable):
 
         m = Module()
 
-        # Low frequency clock (10 kHz oscillator / divider)
+        # Device rate, 1 when the device runs at every clock cycle
+        enable = Const(1)
+        rst = conn_in.rst
+
+        if self.clock_source == self.CLOCK_LFOSC:
+
+            # Low frequency clock (10 kHz oscillator / divider)
+
+            div = int(math.ceil(self.LFOSC_FREQ / self.clock_freq))
+            assert is_power2(div), f"invalid clock divide {div}"
 
-        div = int(math.ceil(10e3 / config.CLOCK_FREQ))
-        assert is_power2(div), f"invalid clock divide {div}"
+            clk_freq = self.LFOSC_FREQ / div
 
-        clk_freq = 10e3 / div
+            self.logger.info(f"LFOSC divider: {div}")
+            self.logger.info(f"clock: {clk_freq:.3f} Hz")
 
-        self.logger.info(f"LFOSC divider: {div}")
-        self.logger.info(f"clock: {clk_freq:.3f} Hz")
+            # TODO: oscillator should only be enabled 100us after powering it up
+            lf_clk = Signal()
+            osc = Instance("SB_LFOSC", i_CLKLFPU=1, i_CLKLFEN=1, o_CLKLF=lf_clk)
+            platform.add_clock_constraint(lf_clk, self.LFOSC_FREQ)
+            m.submodules += osc
 
-        # TODO: oscillator should only be enabled 100us after powering it up
-        lf_clk = Signal()
-        osc = Instance("SB_LFOSC", i_CLKLFPU=1, i_CLKLFEN=1, o_CLKLF=lf_clk)
-        platform.add_clock_constraint(lf_clk, 10e3)
-        m.submodules += osc
+            m.domains.osc = ClockDomain()
+            m.d.comb += ClockSignal("osc").eq(lf_clk)
 
-        m.domains.osc = ClockDomain()
-        m.d.comb += ClockSignal("osc").eq(lf_clk)
+            if div > 1:
 
-        if div > 1:
+                clock_counter = Signal(div.bit_length() - 1)
+                m.d.osc += clock_counter.eq(clock_counter + 1)
 
-            clock_counter = Signal(div // 2)
-            m.d.osc += clock_counter.eq(clock_counter + 1)
+                # TODO: use a global buffer?
+                clk = Signal()
+                m.d.comb += clk.eq(clock_counter[-1])
 
-            # TODO: use a global buffer?
-            clk = Signal()
-            m.d.comb += clk.eq(clock_counter[-1])
+                platform.add_clock_constraint(clk, clk_freq)
 
-            platform.add_clock_constraint(clk, clk_freq)
+            else:
+                clk = lf_clk
+
+            platform.lookup(platform.default_clk).attrs['GLOBAL'] = False
+
+            decoder_domain, decoder_clock_freq = ("osc", self.LFOSC_FREQ) if self.fast_decoder else (None, None)
+
+            assert not self.fast_decoder or div > 1, "fast decoder requires a divided oscillator clock"
 
         else:
-            clk = lf_clk
 
-        platform.lookup(platform.default_clk).attrs['GLOBAL'] = False
+            if self.clock_source == self.CLOCK_BOARD:
+
+                # Board clock (12 MHz)
+
+                source_freq = platform.default_clk_frequency
+                assert self.source_freq is None or self.source_freq == source_freq, \
+                    f"board clock frequency is {source_freq}"
+
+                # Already constrained by the platform
+                clk = platform.request(platform.default_clk).i
+
+            elif self.clock_source == self.CLOCK_HFOSC:
+
+                # High frequency oscillator (48 MHz / 1, 2, 4 or 8), through a global buffer
+
+                hf_div = int(round(self.HFOSC_FREQ / self.source_freq))
+                assert hf_div in (1, 2, 4, 8), f"unsupported HFOSC frequency {self.source_freq}"
+                source_freq = self.HFOSC_FREQ / hf_div
+
+                hf_clk = Signal()
+                clk = Signal()
+                m.submodules += [
+                    Instance(
+                        "SB_HFOSC", p_CLKHF_DIV=f"0b{hf_div.bit_length() - 1:02b}",
+                        i_CLKHFPU=1, i_CLKHFEN=1, o_CLKHF=hf_clk),
+                    Instance("SB_GB", i_USER_SIGNAL_TO_GLOBAL_BUFFER=hf_clk, o_GLOBAL_BUFFER_OUTPUT=clk)
+                ]
+
+                platform.add_clock_constraint(clk, source_freq)
+
+                self.logger.info(f"HFOSC divider: {hf_div}")
+
+            else:
+
+                # PLL from the board clock, on its global output
+
+                f_in = platform.default_clk_frequency
+                divr, divf, divq, filter_range, source_freq = self.get_pll_params(
+                    f_in, self.source_freq)
+
+                clk_pin = platform.request(platform.default_clk, dir="-")
+                clk = Signal()
+                lock = Signal()
+                m.submodules += Instance(
+                    "SB_PLL40_PAD",
+                    p_FEEDBACK_PATH="SIMPLE",
+                    p_DIVR=divr, p_DIVF=divf, p_DIVQ=divq, p_FILTER_RANGE=filter_range,
+                    i_PACKAGEPIN=clk_pin.io, i_RESETB=1, i_BYPASS=0,
+                    o_PLLOUTGLOBAL=clk, o_LOCK=lock)
+
+                # Held in reset until the PLL locks
+                rst = rst | ~lock
+
+                platform.add_clock_constraint(clk, source_freq)
+
+                self.logger.info(f"PLL: DIVR {divr}, DIVF {divf}, DIVQ {divq}, FILTER_RANGE {filter_range}")
+
+            # The device is enabled once every div cycles of the global clock
+            div = int(round(source_freq / self.clock_freq))
+            assert div >= 1, f"clock frequency {self.clock_freq} too high for {source_freq}"
+
+            clk_freq = source_freq / div
+
+            assert not self.fast_decoder or div > 1, "fast decoder requires a clock enable divider"
+
+            self.logger.info(f"global clock: {source_freq:.3f} Hz, clock enable divider: {div}")
+            self.logger.info(f"clock: {clk_freq:.3f} Hz")
+            if clk_freq != self.clock_freq:
+                self.logger.warning(f"clock differs from the requested {self.clock_freq:.3f} Hz")
+
+            enable_counter = Signal(range(div))
+            enable = Signal()
+            m.d.sync += enable_counter.eq(Mux(enable_counter == div - 1, 0, enable_counter + 1))
+            m.d.comb += enable.eq(enable_counter == 0)
+
+            # Decoder at the global clock rate, not enabled
+            m.domains.fast = ClockDomain()
+            m.d.comb += [
+                ClockSignal("fast").eq(clk),
+                ResetSignal("fast").eq(rst)
+            ]
+
+            decoder_domain, decoder_clock_freq = ("fast", source_freq) if self.fast_decoder else (None, None)
+
         m.domains.sync = ClockDomain()
         m.d.comb += [
             ClockSignal("sync").eq(clk),
-            ResetSignal("sync").eq(conn_in.rst)
+            ResetSignal("sync").eq(rst)
         ]
 
         # Project
 
-        top = Device()
-        m.submodules += top
+        top = Device(clock_freq=clk_freq, decoder_domain=decoder_domain, decoder_clock_freq=decoder_clock_freq)
+        m.submodules.top = EnableInserter(enable)(top)
 
         m.d.comb += [
             top.channels.eq(conn_in.channels),
@@ -108,10 +276,10 @@ class ICEBreakerDevice(Elaboratable):
             top.sck.eq(conn_in.sck),
             top.sdi.eq(conn_in.sdi),
 
-            conn_out.counter.eq(top.counter),
-            conn_out.direction.eq(top.direction),
-            conn_out.pwm.eq(top.pwm),
-            conn_out.serial.eq(top.serial_tx)
+            conn_out.serial.eq(top.outputs[0]),
+            conn_out.pwm.eq(top.outputs[1]),
+            conn_out.direction.eq(top.outputs[2]),
+            conn_out.counter.eq(top.outputs[3:])
         ]
 
         # PWM and gear indicator LEDs of break-off PMOD
@@ -136,7 +304,7 @@ class ICEBreakerDevice(Elaboratable):
 
         dbg = platform.request("debug")
         m.d.comb += [
-            dbg.clk.eq(ClockSignal("sync"))
+            dbg.clk.eq(ClockSignal("sync") & enable)
         ]
 
         return m